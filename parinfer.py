@@ -9,8 +9,12 @@
 ## Released under the ISC license
 ## https://github.com/oakmac/parinfer.py/blob/master/LICENSE.md
 
+import collections
+import itertools
+import os
 import re
 import sys
+import time
 
 #-------------------------------------------------------------------------------
 # Constants
@@ -30,7 +34,7 @@ LINE_ENDING_REGEX = re.compile(r"\r?\n")
 
 CLOSE_PARENS = frozenset(['}', ')', ']'])
 OPEN_PARENS = frozenset(['{', '(', '['])
-WHITESPACE = frozenset([NEWLINE, BLANK_SPACE, TAB])
+WHITESPACE = frozenset([NEWLINE, BLANK_SPACE, DOUBLE_SPACE, TAB])
 
 MATCH_PAREN = {
     '{': '}',
@@ -44,6 +48,9 @@ MATCH_PAREN = {
 # toggle this to check the asserts during development
 RUN_ASSERTS = False
 
+# toggle this to process every line char-by-char (e.g. to benchmark the fast paths)
+USE_FAST_PATHS = True
+
 #-------------------------------------------------------------------------------
 # Options Structure
 #-------------------------------------------------------------------------------
@@ -137,24 +144,28 @@ class Result:
     """Returns a dictionary of the initial state."""
     __slots__ = (
         'mode', 'smart',
-        'origText', 'origCursorX', 'origCursorLine',
+        'origText', 'origCursorX', 'origCursorLine', 'changed',
         'inputLines',
         'inputLineNo', 'inputX',
         'lines', 'lineNo', 'ch', 'x', 'indentX',
         'parenStack',
         'tabStops', 'parenTrail',
         'parenTrails',
-        'returnParens', 'parens',
+        'returnParens', 'parens', 'returnEdits', 'returnText',
         'cursorX', 'cursorLine', 'prevCursorX', 'prevCursorLine',
         'selectionStartLine',
         'changes',
         'isInCode', 'isEscaping', 'isEscaped', 'isInStr', 'isInComment',
         'commentX',
         'quoteDanger', 'trackingIndent', 'skipChar', 'success', 'partialResult',
-        'forceBalance', 'maxIndent', 'indentDelta', 'trackingArgTabStop',
+        'forceBalance', 'maxIndent', 'indentDelta', 'shiftedOpeners', 'trackingArgTabStop',
         'error',
         'errorPosCache',
-        'comment')
+        'comment',
+        'lineEdits', 'lineEditsEnd',
+        'checkpoints', 'prevCheckpoints', 'editRange', 'convergeAt',
+        'cancelToken', 'lineCache', 'lineCacheHits', 'stopOnChange', 'parenIndentStable',
+        'deadline', 'continuationKey', 'continuation', 'stopLineNo', 'fallbackLineNo')
 
     def __str__(self):
         return ('Result {' + 'mode: ' + str(self.mode) + '\n\t'
@@ -162,6 +173,7 @@ class Result:
                 'origText: ' + str(self.origText) + '\n\t'
                 'origCursorX: ' + str(self.origCursorX) + '\n\t'
                 'origCursorLine: ' + str(self.origCursorLine) + '\n\t'
+                'changed: ' + str(self.changed) + '\n\t'
                 'inputLines: ' + str(self.inputLines) + '\n\t'
                 'inputLineNo: ' + str(self.inputLineNo) + '\n\t'
                 'inputX: ' + str(self.inputX) + '\n\t'
@@ -176,6 +188,8 @@ class Result:
                 'parenTrails: ' + str(self.parenTrails) + '\n\t'
                 'returnParens: ' + str(self.returnParens) + '\n\t'
                 'parens: ' + str(self.parens) + '\n\t'
+                'returnEdits: ' + str(self.returnEdits) + '\n\t'
+                'returnText: ' + str(self.returnText) + '\n\t'
                 'cursorX: ' + str(self.cursorX) + '\n\t'
                 'cursorLine: ' + str(self.cursorLine) + '\n\t'
                 'prevCursorX: ' + str(self.prevCursorX) + '\n\t'
@@ -196,10 +210,27 @@ class Result:
                 'forceBalance: ' + str(self.forceBalance) + '\n\t'
                 'maxIndent: ' + str(self.maxIndent) + '\n\t'
                 'indentDelta: ' + str(self.indentDelta) + '\n\t'
+                'shiftedOpeners: ' + str(self.shiftedOpeners) + '\n\t'
                 'trackingArgTabStop: ' + str(self.trackingArgTabStop) + '\n\t'
                 'error: ' + str(self.error) + '\n\t'
                 'errorPosCache: ' + str(self.errorPosCache) + '\n\t'
-                'comment: ' + str(self.comment) + '\n\t}')
+                'comment: ' + str(self.comment) + '\n\t'
+                'lineEdits: ' + str(self.lineEdits) + '\n\t'
+                'lineEditsEnd: ' + str(self.lineEditsEnd) + '\n\t'
+                'checkpoints: ' + str(self.checkpoints) + '\n\t'
+                'prevCheckpoints: ' + str(self.prevCheckpoints) + '\n\t'
+                'editRange: ' + str(self.editRange) + '\n\t'
+                'convergeAt: ' + str(self.convergeAt) + '\n\t'
+                'cancelToken: ' + str(self.cancelToken) + '\n\t'
+                'lineCache: ' + str(self.lineCache) + '\n\t'
+                'lineCacheHits: ' + str(self.lineCacheHits) + '\n\t'
+                'stopOnChange: ' + str(self.stopOnChange) + '\n\t'
+                'parenIndentStable: ' + str(self.parenIndentStable) + '\n\t'
+                'deadline: ' + str(self.deadline) + '\n\t'
+                'continuationKey: ' + str(self.continuationKey) + '\n\t'
+                'continuation: ' + str(self.continuation) + '\n\t'
+                'stopLineNo: ' + str(self.stopLineNo) + '\n\t'
+                'fallbackLineNo: ' + str(self.fallbackLineNo) + '\n\t}')
 
     def __init__(self, text, options, mode, smart):
         """Constructs a dictionary of the initial state."""
@@ -213,12 +244,15 @@ class Result:
         self.origCursorLine = None      # [integer] - original cursorLine option
 
                                         # [string array] - input lines that we process line-by-line char-by-char
-        self.inputLines = re.split(LINE_ENDING_REGEX, text)
+        self.inputLines = splitLines(text)
 
         self.inputLineNo = -1           # [integer] - the current input line number
         self.inputX = -1                # [integer] - the current input x position of the current character (ch)
 
         self.lines = []                 # [string array] - output lines (with corrected parens or indentation)
+        self.changed = False            # [boolean] - set once an edit changes one of `lines` (even if a later edit undoes it)
+        self.lineEdits = None           # [array of (start, end, replace)] - edits to the current line not yet applied to `lines`
+        self.lineEditsEnd = 0           # [integer] - x position after the last of `lineEdits`
         self.lineNo = -1                # [integer] - output line number we are on
         self.ch = ''                    # [string] - character we are processing (can be changed to indicate a replacement)
         self.x = 0                      # [integer] - output x position of the current character (ch)
@@ -238,6 +272,8 @@ class Result:
 
         self.returnParens = False       # [boolean] - determines if we return `parens` described below
         self.parens = []                # [array of {lineNo, x, closer, children}] - paren tree if `returnParens` is h
+        self.returnEdits = False        # [boolean] - determines if we return the `edits` and `changedLines` that turn the input into `text`
+        self.returnText = True          # [boolean] - determines if we return `text` (not by default with `returnEdits`)
 
         self.cursorX = None             # [integer] - x position of the cursor
         self.cursorLine = None          # [integer] - line number of the cursor
@@ -265,6 +301,7 @@ class Result:
         self.maxIndent = sys.maxsize    # [integer] - maximum allowed indentation of subsequent lines in Paren Mode
         self.indentDelta = 0            # [integer] - how far indentation was shifted by Paren Mode
                                         #  (preserves relative indentation of nested expressions)
+        self.shiftedOpeners = False     # [boolean] - may the paren stack or trail hold an opener with a nonzero indentDelta?
 
         self.trackingArgTabStop = None  # [string] - enum to track how close we are to the first-arg tabStop in a list
                                         #  For example a tabStop occurs at `bar` below:
@@ -293,6 +330,22 @@ class Result:
         }
         self.errorPosCache = {}         # [object] - maps error name to a potential error position
 
+        self.checkpoints = None         # [object] - maps line number to a Checkpoint if `returnCheckpoints` is set
+        self.prevCheckpoints = None     # [Checkpoints] - snapshots from a previous run to resume from
+        self.editRange = None           # [object] - {lineNo, oldEndLineNo, newEndLineNo} lines edited since `prevCheckpoints`
+        self.convergeAt = None          # [object] - maps line number to previous snapshots we may converge with
+
+        self.cancelToken = None         # [CancelToken] - checked between lines to stop work that is no longer needed
+        self.lineCache = None           # [LineCache] - replays lines seen before in the same state (see `enable_line_cache`)
+        self.lineCacheHits = 0          # [integer] - number of lines replayed from `lineCache`
+        self.stopOnChange = False       # [boolean] - raise LineChanged instead of changing a line (`lines` is then `inputLines`)
+        self.parenIndentStable = True   # [boolean] - Smart Mode: would Paren Mode keep the indentation of every line so far?
+        self.deadline = None            # [float] - `time.monotonic()` after which we stop between lines (from `deadline` or `budget`)
+        self.continuationKey = None     # [tuple] - the text and options a Continuation of this run is valid for
+        self.continuation = None        # [Continuation] - where to continue from, or where we stopped once `stopLineNo` is set
+        self.stopLineNo = None          # [integer] - first line not processed because the deadline passed
+        self.fallbackLineNo = None      # [integer] - line Paren Mode started from after Smart Mode fell back to it
+
         if isinstance(options, dict):
             if 'cursorX' in options:
                 self.cursorX = options['cursorX']
@@ -314,8 +367,37 @@ class Result:
                 self.forceBalance = options['forceBalance']
             if 'returnParens' in options:
                 self.returnParens = options['returnParens']
+            if 'returnEdits' in options:
+                self.returnEdits = options['returnEdits']
+                self.returnText = not self.returnEdits
+            if 'returnText' in options:
+                self.returnText = options['returnText']
             if 'comment' in options:
                 self.comment = options['comment']
+            if 'cancelToken' in options:
+                self.cancelToken = options['cancelToken']
+            if options.get('stopOnChange'):
+                self.stopOnChange = True
+                self.lines = self.inputLines
+            if not self.returnParens:
+                if options.get('returnCheckpoints') or options.get('checkpoints'):
+                    self.checkpoints = {}
+                self.prevCheckpoints = options.get('checkpoints')
+                self.editRange = options.get('editRange')
+            if not self.returnParens and self.checkpoints is None:
+                if options.get('deadline') is not None:
+                    self.deadline = options['deadline']
+                if options.get('budget') is not None:
+                    budgetDeadline = time.monotonic() + options['budget'] / 1000
+                    self.deadline = budgetDeadline if self.deadline is None else min(self.deadline, budgetDeadline)
+                continuation = options.get('continuation')
+                if self.deadline is not None or continuation is not None:
+                    self.continuationKey = getContinuationKey(text, options, smart)
+                    if continuation is not None and continuation.key == self.continuationKey:
+                        self.continuation = continuation
+
+        if lineCache is not None and canCacheLines(self):
+            self.lineCache = lineCache
 
 #-------------------------------------------------------------------------------
 # Possible Errors
@@ -354,6 +436,26 @@ def cacheErrorPos(result, errorName):
 class ParinferError(Exception):
     pass
 
+class ParinferCancelled(Exception):
+    """Raised when the `cancelToken` option was cancelled during processing."""
+    pass
+
+class LineChanged(Exception):
+    """Raised at the first edit that changes a line when the `stopOnChange`
+    option is set (see `is_stable`)."""
+    def __init__(self, lineNo, x):
+        super(LineChanged, self).__init__(lineNo, x)
+        self.lineNo = lineNo
+        self.x = x
+
+class CancelToken(object):
+    __slots__ = ('cancelled',)
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
 def error(result, name):
     cache = result.errorPosCache.get(name, {})
 
@@ -409,6 +511,12 @@ if RUN_ASSERTS:
     assert replaceWithinString('aaa', 0, 1, 'b') == 'baa'
     assert replaceWithinString('aaa', 0, 2, 'b') == 'ba'
 
+def splitLines(text):
+    # str.split is much faster than the regex when there are no CRLF line-endings
+    if text.find("\r") == -1:
+        return text.split(NEWLINE)
+    return re.split(LINE_ENDING_REGEX, text)
+
 def getLineEnding(text):
     # NOTE: We assume that if the CR char "\r" is used anywhere,
     #       then we should use CRLF line-endings after every line.
@@ -438,12 +546,58 @@ def shiftCursorOnEdit(result, lineNo, start, end, replace):
         result.cursorX += dx
 
 def replaceWithinLine(result, lineNo, start, end, replace):
-    line = result.lines[lineNo]
-    newLine = replaceWithinString(line, start, end, replace)
-    result.lines[lineNo] = newLine
+    if result.stopOnChange:
+        # nothing has changed yet, so x positions are still input positions
+        if result.lines[lineNo][start:end] != replace:
+            raise LineChanged(lineNo, start)
+        shiftCursorOnEdit(result, lineNo, start, end, replace)
+        return
+    if result.lineEdits is not None and lineNo == result.lineNo:
+        # defer edits to the current line while they move left-to-right
+        if start < result.lineEditsEnd:
+            commitLineEdits(result)
+            result.lineEdits = []
+        result.lineEdits.append((start, end, replace))
+        result.lineEditsEnd = start + len(replace)
+    else:
+        line = result.lines[lineNo]
+        if line[start:end] != replace:
+            result.lines[lineNo] = replaceWithinString(line, start, end, replace)
+            result.changed = True
 
     shiftCursorOnEdit(result, lineNo, start, end, replace)
 
+def commitLineEdits(result):
+    """Applies the deferred edits to the current line in a single pass."""
+    edits = result.lineEdits
+    result.lineEdits = None
+    result.lineEditsEnd = 0
+    if not edits:
+        return
+
+    line = result.lines[result.lineNo]
+    chunks = []
+    pos = 0
+    offset = 0  # how far the x positions of later edits have shifted from `line`
+    for start, end, replace in edits:
+        chunks.append(line[pos:start-offset])
+        chunks.append(replace)
+        pos = end - offset
+        offset += len(replace) - (end - start)
+    chunks.append(line[pos:])
+    newLine = ''.join(chunks)
+    if newLine != line:
+        result.lines[result.lineNo] = newLine
+        result.changed = True
+
+def getCurrentLine(result):
+    """Returns the current line with its deferred edits applied, so that x
+    positions index into it."""
+    if result.lineEdits:
+        commitLineEdits(result)
+        result.lineEdits = []
+    return result.lines[result.lineNo]
+
 def insertWithinLine(result, lineNo, idx, insert):
     replaceWithinLine(result, lineNo, idx, idx, insert)
 
@@ -570,10 +724,9 @@ def trackArgTabStop(result, state):
 #-------------------------------------------------------------------------------
 
 class Opener(object):
-    __slots__ = ('self', 'inputLineNo', 'inputX', 'lineNo', 'x', 'ch', 'indentDelta',
+    __slots__ = ('inputLineNo', 'inputX', 'lineNo', 'x', 'ch', 'indentDelta',
                  'maxChildIndent', 'argX', 'children', 'closer')
     def __init__(self, inputLineNo, inputX, lineNo, x, ch, indentDelta, maxChildIndent):
-        super(Opener, self).__init__()
         self.inputLineNo = inputLineNo
         self.inputX = inputX
         self.lineNo = lineNo
@@ -620,6 +773,8 @@ def onOpenParen(result):
 
         result.parenStack.append(opener)
         result.trackingArgTabStop = 'space'
+        if opener.indentDelta != 0:
+            result.shiftedOpeners = True
 
 def setCloser(opener, lineNo, x, ch):
     opener.closer['lineNo'] = lineNo
@@ -817,10 +972,11 @@ def clampParenTrailToCursor(result):
         newStartX = max(startX, result.cursorX)
         newEndX = max(endX, result.cursorX)
 
-        line = result.lines[result.lineNo]
+        # the cursor may be past the end of the line
+        line = getCurrentLine(result)
         removeCount = 0
-        for i in range(startX, newStartX):
-            if line[i] in CLOSE_PARENS:
+        for ch in line[startX:newStartX]:
+            if ch in CLOSE_PARENS:
                 removeCount += 1
 
         openers = result.parenTrail.openers
@@ -1029,18 +1185,19 @@ def getParentOpenerIndex(result, indentX):
 
 # INDENT MODE: correct paren trail from indentation
 def correctParenTrail(result, indentX):
-    parens = ''
+    parens = []
 
     index = getParentOpenerIndex(result, indentX)
     for i in range(index):
         opener = result.parenStack.pop()
         result.parenTrail.openers.append(opener)
         closeCh = MATCH_PAREN[opener.ch]
-        parens += closeCh
+        parens.append(closeCh)
 
         if result.returnParens:
             setCloser(opener, result.parenTrail.lineNo, result.parenTrail.startX+i, closeCh)
 
+    parens = ''.join(parens)
     if result.parenTrail.lineNo is not None:
         replaceWithinLine(result, result.parenTrail.lineNo, result.parenTrail.startX, result.parenTrail.endX, parens)
         result.parenTrail.endX = result.parenTrail.startX + len(parens)
@@ -1055,17 +1212,13 @@ def cleanParenTrail(result):
         result.lineNo != result.parenTrail.lineNo):
         return
 
-    line = result.lines[result.lineNo]
-    newTrail = ''
-    spaceCount = 0
-    for i in range(startX, endX):
-        if line[i] in CLOSE_PARENS:
-            newTrail += line[i]
-        else:
-            spaceCount += 1
+    line = getCurrentLine(result)
+    assert endX <= len(line), 'paren trail runs past the end of the line'
+    newTrail = [ch for ch in line[startX:endX] if ch in CLOSE_PARENS]
+    spaceCount = (endX - startX) - len(newTrail)
 
     if spaceCount > 0:
-        replaceWithinLine(result, result.lineNo, startX, endX, newTrail)
+        replaceWithinLine(result, result.lineNo, startX, endX, ''.join(newTrail))
         result.parenTrail.endX -= spaceCount
 
 # PAREN MODE: append a valid close-paren to the end of the paren trail
@@ -1102,8 +1255,7 @@ def setMaxIndent(result, opener):
 
 def rememberParenTrail(result):
     trail = result.parenTrail
-    openers = trail.clamped.openers + trail.openers
-    if len(openers) > 0:
+    if trail.openers or trail.clamped.openers:
         isClamped = trail.clamped.startX is not None
         allClamped = len(trail.openers) == 0
         shortTrail = {
@@ -1114,8 +1266,8 @@ def rememberParenTrail(result):
         result.parenTrails.append(shortTrail)
 
         if result.returnParens:
-            for i in range(len(openers)):
-                openers[i].closer['trail'] = shortTrail
+            for opener in trail.clamped.openers + trail.openers:
+                opener.closer['trail'] = shortTrail
 
 def updateRememberedParenTrail(result):
     if result.parenTrails:
@@ -1135,6 +1287,9 @@ def finishNewParenTrail(result):
         invalidateParenTrail(result)
     elif result.mode == INDENT_MODE:
         clampParenTrailToCursor(result)
+        if result.smart:
+            # keep Paren Mode's indentation limits in case we fall back to it
+            setMaxIndent(result, peek(result.parenTrail.openers, 0))
         popParenTrail(result)
     elif result.mode == PAREN_MODE:
         setMaxIndent(result, peek(result.parenTrail.openers, 0))
@@ -1155,6 +1310,12 @@ def addIndent(result, delta):
     result.indentX = newIndent
     result.indentDelta += delta
 
+def hasShiftedOpener(openers):
+    for opener in openers:
+        if opener.indentDelta != 0:
+            return True
+    return False
+
 def shouldAddOpenerIndent(result, opener):
     # Don't add opener.indentDelta if the user already added it.
     # (happens when multiple lines are indented together)
@@ -1192,6 +1353,8 @@ def onIndent(result):
         opener = peek(result.parenStack, 0)
         if opener and shouldAddOpenerIndent(result, opener):
             addIndent(result, opener.indentDelta)
+        if result.smart and result.x > (opener.maxChildIndent if opener else result.maxIndent):
+            result.parenIndentStable = False
     elif result.mode == PAREN_MODE:
         correctIndent(result)
 
@@ -1223,6 +1386,11 @@ def onLeadingCloseParen(result):
             result.skipChar = True
 
 def onCommentLine(result):
+    # Without any shifted openers, the parent opener can neither shift the
+    # comment line nor be adopted, so we can skip looking for it.
+    if result.indentDelta == 0 and not result.shiftedOpeners:
+        return
+
     parenTrailLength = len(result.parenTrail.openers)
 
     # restore the openers matching the previous paren trail
@@ -1283,6 +1451,253 @@ def setTabStops(result):
         if 'argX' in result.tabStops[i-1] and result.tabStops[i-1]['argX'] >= x:
             del result.tabStops[i-1]['argX']
 
+#-------------------------------------------------------------------------------
+# Checkpoints
+#-------------------------------------------------------------------------------
+
+# When `returnCheckpoints` is set, we record a snapshot of the parser state at
+# the start of every CHECKPOINT_INTERVAL-th line.  A later call can pass these
+# back as `checkpoints` along with the `editRange` that changed, so that we
+# resume from the nearest snapshot above the edit instead of line 0, and stop
+# scanning once our state matches the previous run again below the edit.
+#
+#    editRange = {'lineNo': 10, 'oldEndLineNo': 10, 'newEndLineNo': 12}
+#                  ^ first edited line
+#                                ^ last edited line before/after the edit (inclusive)
+
+CHECKPOINT_INTERVAL = 32
+
+class Checkpoint(object):
+    __slots__ = ('lineNo', 'state', 'trailsLen')
+    def __init__(self, lineNo, state, trailsLen):
+        self.lineNo = lineNo         # [integer] - line about to be processed when this was taken
+        self.state = state           # [tuple] - hashable parser state (see `snapshotState`)
+        self.trailsLen = trailsLen   # [integer] - len(result.parenTrails) at this point
+
+class Checkpoints(object):
+    """Snapshots from a previous run, returned to the user as `checkpoints`."""
+    __slots__ = ('optionsKey', 'cursorLine', 'prevCursorLine', 'minLineNo', 'maxLineNo',
+                 'success', 'lines', 'parenTrails', 'snapshots')
+
+def getOptionsKey(result):
+    return (result.mode, result.smart, result.forceBalance, result.partialResult, result.comment)
+
+def getCursorLines(result):
+    # lines whose processing depends on the cursor, selection or changes options
+    lineNos = [result.cursorLine, result.prevCursorLine, result.selectionStartLine]
+    if result.changes:
+        lineNos.extend(result.changes)
+    return [lineNo for lineNo in lineNos if lineNo is not None]
+
+def snapshotOpener(opener):
+    return (opener.inputLineNo, opener.inputX, opener.lineNo, opener.x, opener.ch,
+            opener.indentDelta, opener.maxChildIndent, opener.argX)
+
+def restoreOpener(t):
+    opener = Opener(t[0], t[1], t[2], t[3], t[4], t[5], t[6])
+    opener.argX = t[7]
+    return opener
+
+def snapshotState(result):
+    trail = result.parenTrail
+    trailLine = result.lines[trail.lineNo] if trail.lineNo is not None else None
+    lastTrail = None
+    if result.parenTrails:
+        t = result.parenTrails[-1]
+        lastTrail = (t['lineNo'], t['startX'], t['endX'])
+    return (
+        result.isInCode, result.isEscaping, result.isEscaped,
+        result.isInStr, result.isInComment, result.quoteDanger,
+        result.maxIndent,
+        tuple(snapshotOpener(o) for o in result.parenStack),
+        (trail.lineNo, trail.startX, trail.endX,
+         tuple(snapshotOpener(o) for o in trail.openers),
+         trail.clamped.startX, trail.clamped.endX,
+         tuple(snapshotOpener(o) for o in trail.clamped.openers)),
+        trailLine,
+        tuple(sorted((name, e['lineNo'], e['x'], e['inputLineNo'], e['inputX'])
+                     for name, e in result.errorPosCache.items())),
+        lastTrail,
+    )
+
+def shiftState(state, afterLineNo, delta):
+    """Renumbers the line numbers in a snapshot that lie below an edit."""
+    if delta == 0:
+        return state
+
+    def shift(lineNo):
+        return lineNo + delta if lineNo is not None and lineNo > afterLineNo else lineNo
+    def shiftOpener(t):
+        return (shift(t[0]), t[1], shift(t[2])) + t[3:]
+    def shiftOpeners(openers):
+        return tuple(shiftOpener(t) for t in openers)
+
+    trail = state[8]
+    lastTrail = state[11]
+    return state[:7] + (
+        shiftOpeners(state[7]),
+        (shift(trail[0]), trail[1], trail[2], shiftOpeners(trail[3]),
+         trail[4], trail[5], shiftOpeners(trail[6])),
+        state[9],
+        tuple((e[0], shift(e[1]), e[2], shift(e[3]), e[4]) for e in state[10]),
+        (shift(lastTrail[0]),) + lastTrail[1:] if lastTrail else None,
+    )
+
+def restoreState(result, cp, prev):
+    state = cp.state
+    (result.isInCode, result.isEscaping, result.isEscaped,
+     result.isInStr, result.isInComment, result.quoteDanger,
+     result.maxIndent) = state[:7]
+    result.parenStack = [restoreOpener(t) for t in state[7]]
+
+    trail = state[8]
+    result.parenTrail.lineNo = trail[0]
+    result.parenTrail.startX = trail[1]
+    result.parenTrail.endX = trail[2]
+    result.parenTrail.openers = [restoreOpener(t) for t in trail[3]]
+    result.parenTrail.clamped.startX = trail[4]
+    result.parenTrail.clamped.endX = trail[5]
+    result.parenTrail.clamped.openers = [restoreOpener(t) for t in trail[6]]
+    result.shiftedOpeners = (hasShiftedOpener(result.parenStack) or
+                             hasShiftedOpener(result.parenTrail.openers))
+
+    result.errorPosCache = {}
+    for name, lineNo, x, inputLineNo, inputX in state[10]:
+        result.errorPosCache[name] = {
+            'lineNo': lineNo,
+            'x': x,
+            'inputLineNo': inputLineNo,
+            'inputX': inputX
+        }
+
+    # lines above the checkpoint are final, except for the paren trail line
+    # which later lines may still append to or correct.
+    result.lines = prev.lines[:cp.lineNo]
+    result.changed = True  # we don't know if the previous run changed these lines
+    if trail[0] is not None:
+        result.lines[trail[0]] = state[9]
+    result.parenTrails = [dict(t) for t in prev.parenTrails[:cp.trailsLen]]
+    if state[11]:
+        result.parenTrails[-1]['endX'] = state[11][2]
+    result.lineNo = cp.lineNo - 1
+
+def resumeFromCheckpoint(result):
+    """Restores the nearest usable checkpoint above the edit, returning the
+    line number to continue processing from."""
+    prev = result.prevCheckpoints
+    editRange = result.editRange
+    if (prev is None or editRange is None or
+            prev.optionsKey != getOptionsKey(result)):
+        return 0
+
+    editLineNo = editRange['lineNo']
+    oldEndLineNo = editRange['oldEndLineNo']
+    newEndLineNo = editRange['newEndLineNo']
+    delta = newEndLineNo - oldEndLineNo
+
+    cursorLines = getCursorLines(result)
+    limit = min([editLineNo, prev.minLineNo] + cursorLines)
+    startLineNo = max((lineNo for lineNo in prev.snapshots if lineNo <= limit), default=None)
+    if startLineNo is None:
+        return 0
+
+    for lineNo, cp in prev.snapshots.items():
+        if lineNo <= startLineNo:
+            result.checkpoints[lineNo] = cp
+    restoreState(result, prev.snapshots[startLineNo], prev)
+
+    # below the edit and below every cursor-dependent line of both runs,
+    # the rest of the previous run can be reused once our states match.
+    if prev.success:
+        minOldLineNo = max(oldEndLineNo, prev.maxLineNo)
+        minNewLineNo = max([newEndLineNo] + cursorLines)
+        result.convergeAt = {}
+        for lineNo, cp in prev.snapshots.items():
+            if lineNo > minOldLineNo and lineNo + delta > minNewLineNo:
+                shifted = Checkpoint(lineNo + delta, shiftState(cp.state, oldEndLineNo, delta), cp.trailsLen)
+                result.convergeAt[lineNo + delta] = (shifted, cp)
+
+    return startLineNo
+
+def canConverge(result, cp, oldCp):
+    prev = result.prevCheckpoints
+    trailLineNo = cp.state[8][0]
+    if trailLineNo is not None and (
+            trailLineNo == result.cursorLine or oldCp.state[8][0] == prev.cursorLine):
+        # the previous run may still shift its cursor when correcting this trail
+        return False
+    if result.smart:
+        # closing an opener on a cursor line may trigger cursor holding
+        for t in cp.state[7]:
+            if t[2] == result.cursorLine or t[2] == result.prevCursorLine:
+                return False
+        for t in oldCp.state[7]:
+            if t[2] == prev.cursorLine or t[2] == prev.prevCursorLine:
+                return False
+    return True
+
+def convergeWithCheckpoint(result, cp, oldCp):
+    prev = result.prevCheckpoints
+    delta = cp.lineNo - oldCp.lineNo
+    oldTrailLineNo = oldCp.state[8][0]
+    if oldTrailLineNo is not None:
+        result.lines[result.parenTrail.lineNo] = prev.lines[oldTrailLineNo]
+    result.lines.extend(prev.lines[oldCp.lineNo:])
+    result.changed = True
+
+    hasLastTrail = cp.state[11] is not None
+    newTrailsLen = cp.trailsLen - hasLastTrail
+    oldTrails = prev.parenTrails[oldCp.trailsLen - hasLastTrail:]
+    del result.parenTrails[newTrailsLen:]
+    oldEndLineNo = result.editRange['oldEndLineNo']
+    for t in oldTrails:
+        t = dict(t)
+        if t['lineNo'] > oldEndLineNo:
+            t['lineNo'] += delta
+        result.parenTrails.append(t)
+
+    trailsDelta = cp.trailsLen - oldCp.trailsLen
+    for oldLineNo, oldSnapshot in prev.snapshots.items():
+        if oldLineNo > oldCp.lineNo:
+            lineNo = oldLineNo + delta
+            state = shiftState(oldSnapshot.state, oldEndLineNo, delta)
+            result.checkpoints[lineNo] = Checkpoint(lineNo, state, oldSnapshot.trailsLen + trailsDelta)
+
+    result.success = True
+
+def checkpointLine(result, lineNo):
+    """Called at the start of each line when recording checkpoints.  Returns
+    True if the rest of the previous run was reused."""
+    converge = result.convergeAt.get(lineNo) if result.convergeAt else None
+    if converge is None and lineNo % CHECKPOINT_INTERVAL != 0:
+        return False
+
+    cp = Checkpoint(lineNo, snapshotState(result), len(result.parenTrails))
+    if converge is not None:
+        shifted, oldCp = converge
+        if cp.state == shifted.state and canConverge(result, cp, oldCp):
+            result.checkpoints[lineNo] = cp
+            convergeWithCheckpoint(result, cp, oldCp)
+            return True
+    if lineNo % CHECKPOINT_INTERVAL == 0:
+        result.checkpoints[lineNo] = cp
+    return False
+
+def makeCheckpoints(result):
+    cursorLines = getCursorLines(result)
+    checkpoints = Checkpoints()
+    checkpoints.optionsKey = getOptionsKey(result)
+    checkpoints.cursorLine = result.cursorLine
+    checkpoints.prevCursorLine = result.prevCursorLine
+    checkpoints.minLineNo = min(cursorLines, default=sys.maxsize)
+    checkpoints.maxLineNo = max(cursorLines, default=-1)
+    checkpoints.success = result.success
+    checkpoints.lines = result.lines
+    # the public result returns `parenTrails` to the caller, who may modify it
+    checkpoints.parenTrails = [dict(t) for t in result.parenTrails]
+    checkpoints.snapshots = result.checkpoints
+    return checkpoints
+
 #-------------------------------------------------------------------------------
 # High-level processing functions
 #-------------------------------------------------------------------------------
@@ -1310,16 +1725,98 @@ def processChar(result, ch):
         result.indentDelta -= (len(origCh) - len(ch))
     result.x += len(ch)
 
+# Inside a string or comment, only a quote or a backslash can change our state.
+# Every other character is kept as-is and just advances `x`, so we can jump
+# straight to the next one of those.
+STR_OR_COMMENT_SPECIAL_REGEX = re.compile(r'["\\]')
+
+def isSkippableRun(result):
+    return (not result.isEscaping and
+            not result.trackingIndent and
+            result.trackingArgTabStop != 'arg')
+
+def skipRun(result, line, x):
+    match = STR_OR_COMMENT_SPECIAL_REGEX.search(line, x)
+    end = match.start() if match else len(line)
+    if end != x:
+        result.x += end - x
+        result.inputX = end - 1
+        result.ch = line[end - 1]
+        result.isEscaped = False
+    return end
+
+# A line in code space without any of these characters cannot open, close or
+# escape anything, so its only effects are its indentation point and moving
+# the paren trail after its last token.
+plainLineRegexes = {}
+
+def isPlainLine(result, line):
+    regex = plainLineRegexes.get(result.comment)
+    if regex is None:
+        regex = re.compile('[' + re.escape('()[]{}"\\\t' + result.comment) + ']')
+        plainLineRegexes[result.comment] = regex
+    return regex.search(line) is None
+
+def processPlainLine(result, line):
+    indent = len(line) - len(line.lstrip(BLANK_SPACE))
+    if indent == len(line):
+        # blank line
+        result.x += indent
+        if line:
+            result.inputX = indent - 1
+            result.ch = BLANK_SPACE
+            result.isEscaped = False
+        return
+
+    # the first token is the indentation point
+    result.x = indent
+    result.inputX = indent
+    result.ch = line[indent]
+    result.skipChar = False
+    onIndent(result)
+    result.isEscaped = False
+    shift = result.x - indent
+
+    lastX = len(line.rstrip(BLANK_SPACE))
+    resetParenTrail(result, result.lineNo, lastX + shift)
+    result.x = len(line) + shift
+    result.inputX = len(line) - 1
+    result.ch = line[-1]
+
 def processLine(result, lineNo):
+    if result.shiftedOpeners and not result.parenStack and not result.parenTrail.openers:
+        result.shiftedOpeners = False
+    if result.lineCache is not None:
+        result.lineCache.processLine(result, lineNo)
+    else:
+        processLineChars(result, lineNo)
+
+def processLineChars(result, lineNo):
     initLine(result)
-    result.lines.append(result.inputLines[lineNo])
+    line = result.inputLines[lineNo]
+    if not result.stopOnChange:
+        result.lines.append(line)
+    result.lineEdits = []
 
     setTabStops(result)
 
-    for x in range(len(result.inputLines[lineNo])):
-        result.inputX = x
-        processChar(result, result.inputLines[lineNo][x])
+    canSkipRuns = USE_FAST_PATHS and not (result.changes and lineNo in result.changes)
+    if canSkipRuns and result.isInCode and isPlainLine(result, line):
+        processPlainLine(result, line)
+    else:
+        lineLen = len(line)
+        x = 0
+        while x < lineLen:
+            for x in range(x, lineLen):
+                result.inputX = x
+                processChar(result, line[x])
+                if not result.isInCode and canSkipRuns and isSkippableRun(result):
+                    x = skipRun(result, line, x + 1)
+                    break
+            else:
+                break
     processChar(result, NEWLINE)
+    commitLineEdits(result)
 
     if not result.forceBalance:
         checkUnmatchedOutsideParenTrail(result)
@@ -1354,31 +1851,913 @@ def processError(result, e):
         result.error.message = e.stack
         raise e
 
-def processText(text, options, mode, smart=False):
+#-------------------------------------------------------------------------------
+# Unclosed quote pre-pass
+#-------------------------------------------------------------------------------
+
+# A string that is never closed makes every line after its opening quote part
+# of the string, and `finalizeResult` can only report it after processing all
+# of them.  So when a line ends inside a string, we look ahead for the quote
+# closing it, which only needs a search for quotes and backslashes in the
+# string's own lines.  If there is none, the rest of the text cannot change the
+# error and we stop right there.  Text without multi-line strings never looks
+# ahead at all.
+
+def canStopAtUnclosedQuote(result):
+    return not (result.partialResult or result.checkpoints is not None or
+                result.comment in (DOUBLE_QUOTE, BACKSLASH))
+
+def findStringEndLineNo(result, lineNo):
+    """Returns the line closing the string that is open at the end of `lineNo`,
+    or None if it is never closed."""
+    lines = result.inputLines
+    for endLineNo in range(lineNo + 1, len(lines)):
+        line = lines[endLineNo]
+        x = 0
+        while True:
+            match = STR_OR_COMMENT_SPECIAL_REGEX.search(line, x)
+            if match is None:
+                break
+            if match.group() == DOUBLE_QUOTE:
+                return endLineNo
+            x = match.end() + 1
+    return None
+
+#-------------------------------------------------------------------------------
+# Deadlines
+#-------------------------------------------------------------------------------
+
+# With a `deadline` (a `time.monotonic()` value) or a `budget` (milliseconds),
+# we check the time between lines and stop once it has passed, returning the
+# line we stopped at, the lines that are final so far (none in Smart Mode until
+# it falls back to Paren Mode) and a `continuation` to pass back in the options
+# to continue where we stopped.  At least one line is processed per call.  A
+# continuation holds a snapshot like a checkpoint, so `returnParens` and
+# checkpoints (which cannot be restored from one) ignore the deadline.
+
+CONTINUATION_KEY_IGNORED_OPTIONS = frozenset(['deadline', 'budget', 'continuation', 'cancelToken'])
+
+class Continuation(object):
+    """The state of a run that stopped at its deadline, returned to the user
+    as `continuation`."""
+    __slots__ = ('key', 'mode', 'checkpoint', 'lines', 'parenTrails', 'tabStops',
+                 'cursorX', 'cursorLine', 'changed', 'parenIndentStable', 'fallbackLineNo',
+                 'parenResume')
+
+def getContinuationKey(text, options, smart):
+    return (text, smart, {k: v for k, v in options.items() if k not in CONTINUATION_KEY_IGNORED_OPTIONS})
+
+def stopAtDeadline(result, lineNo, parenResume):
+    cont = Continuation()
+    cont.key = result.continuationKey
+    cont.mode = result.mode
+    cont.checkpoint = Checkpoint(lineNo, snapshotState(result), len(result.parenTrails))
+    cont.lines = result.lines
+    cont.parenTrails = result.parenTrails
+    cont.tabStops = result.tabStops
+    cont.cursorX = result.cursorX
+    cont.cursorLine = result.cursorLine
+    cont.changed = result.changed
+    cont.parenIndentStable = result.parenIndentStable
+    cont.fallbackLineNo = result.fallbackLineNo
+    cont.parenResume = parenResume
+    result.continuation = cont
+    result.stopLineNo = lineNo
+
+def continueFrom(result):
+    """Restores the state in `result.continuation`, returning the line number
+    to continue processing from."""
+    cont = result.continuation
+    restoreState(result, cont.checkpoint, cont)
+    result.changed = cont.changed
+    result.tabStops = list(cont.tabStops)
+    result.cursorX = cont.cursorX
+    result.cursorLine = cont.cursorLine
+    result.parenIndentStable = cont.parenIndentStable
+    result.fallbackLineNo = cont.fallbackLineNo
+    result.continuation = None
+    return cont.checkpoint.lineNo
+
+def publicPartialResult(result):
+    # like a checkpoint, only the paren trail line can still change, unless
+    # Smart Mode may still fall back to Paren Mode and change any line
+    endLine = result.stopLineNo - 1
+    if result.smart and result.mode == INDENT_MODE:
+        endLine = -1
+    elif result.parenTrail.lineNo is not None:
+        endLine = min(endLine, result.parenTrail.lineNo - 1)
+    lines = result.lines[:endLine+1]
+    final = {
+        'success': True,
+        'partial': True,
+        'startLine': 0,
+        'endLine': endLine,
+        'stopLine': result.stopLineNo,
+        'continuation': result.continuation,
+        'parenTrails': [t for t in result.parenTrails if t['lineNo'] <= endLine],
+        'changed': result.changed and lines != result.inputLines[:endLine+1],
+    }
+    if result.returnText:
+        final['text'] = getLineEnding(result.origText).join(lines)
+    if result.cursorX is not None:
+        final['cursorX'] = result.cursorX
+    if result.cursorLine is not None:
+        final['cursorLine'] = result.cursorLine
+    if result.tabStops:
+        final['tabStops'] = result.tabStops
+    if result.returnEdits:
+        edits, changedLines = makeEdits(result)
+        final['edits'] = [e for e in edits if e['lineNo'] <= endLine]
+        final['changedLines'] = [lineNo for lineNo in changedLines if lineNo <= endLine]
+    if result.fallbackLineNo is not None:
+        final['fallbackLineNo'] = result.fallbackLineNo
+    return final
+
+#-------------------------------------------------------------------------------
+# Smart Mode fallback
+#-------------------------------------------------------------------------------
+
+# When Smart Mode meets a leading close-paren or releases a cursor hold, it
+# falls back to Paren Mode.  Instead of starting over, Paren Mode can resume
+# from the last line that starts a top-level form at column 0 above the
+# cursor and changes, if the lines above it were left unchanged:
+#
+#   - Indent Mode did not correct any indentation or paren trail above it, so
+#     Paren Mode's paren stack is empty there.  Paren Mode would not correct
+#     them either, unless a line is indented past the limits it sets after a
+#     paren trail, which Smart Mode keeps track of in `parenIndentStable`.
+#   - The paren trail before it closed every opener, so Paren Mode's
+#     `maxIndent` is the x of the outermost of them, which Indent Mode has
+#     pushed back onto the bottom of its stack.
+#
+# The result of a fallback has a `fallbackLineNo`: the line Paren Mode started
+# from, which is 0 when it had to start over.
+
+def getMaxParenResumeLineNo(result):
+    if (not result.smart or result.mode != INDENT_MODE or result.returnParens or
+            result.checkpoints is not None):
+        return -1
+    return min(getCursorLines(result), default=sys.maxsize) - 1
+
+def canResumeParenModeAt(result, lineNo):
+    return (result.inputLines[lineNo][:1] in OPEN_PARENS and
+            result.parenIndentStable and len(result.parenStack) != 0 and
+            not result.isInStr and not result.quoteDanger and not result.isEscaping)
+
+def getParenResume(result, resume):
+    """Returns the (lineNo, maxIndent) to resume Paren Mode from after `result`
+    failed in Smart Mode, or None to start over."""
+    if resume is None:
+        return None
+    lineNo = resume[0]
+    if lineNo > result.lineNo or (result.changed and result.lines[:lineNo] != result.inputLines[:lineNo]):
+        return None
+    return resume
+
+def resumeParenMode(result, failed, resume):
+    """Sets up `result` to continue from the line in `resume`, returning it."""
+    lineNo, result.maxIndent = resume
+    result.fallbackLineNo = lineNo
+    if not result.stopOnChange:
+        result.lines = result.inputLines[:lineNo]
+    result.parenTrails = [t for t in failed.parenTrails if t['lineNo'] < lineNo]
+    result.lineNo = lineNo - 1
+    return lineNo
+
+def processText(text, options, mode, smart=False, failed=None, resume=None):
     result = Result(text, options, mode, smart)
+    if failed is not None:
+        # falling back to Paren Mode does not restart the clock
+        result.deadline = failed.deadline
+        result.continuation = None
+        result.fallbackLineNo = 0
+    parenResume = None
     try:
-        for i in range(len(result.inputLines)):
+        if resume is not None:
+            startLineNo = resumeParenMode(result, failed, resume)
+        elif result.continuation is not None:
+            if result.continuation.mode != mode:
+                # Smart Mode had already fallen back to Paren Mode
+                return processText(text, options, result.continuation.mode, smart)
+            parenResume = result.continuation.parenResume
+            startLineNo = continueFrom(result)
+        elif result.checkpoints is not None:
+            startLineNo = resumeFromCheckpoint(result)
+        else:
+            startLineNo = 0
+        canStopAtQuote = canStopAtUnclosedQuote(result)
+        strEndLineNo = -1
+        maxResumeLineNo = getMaxParenResumeLineNo(result)
+        for i in range(startLineNo, len(result.inputLines)):
             result.inputLineNo = i
+            if result.checkpoints is not None and checkpointLine(result, i):
+                break
+            if result.cancelToken is not None and result.cancelToken.cancelled:
+                raise ParinferCancelled()
+            if result.deadline is not None and i != startLineNo and time.monotonic() > result.deadline:
+                stopAtDeadline(result, i, parenResume)
+                break
+            if i <= maxResumeLineNo and canResumeParenModeAt(result, i):
+                parenResume = (i, result.parenStack[0].x)
             processLine(result, i)
-        finalizeResult(result)
+            if result.isInStr and i >= strEndLineNo and canStopAtQuote:
+                strEndLineNo = findStringEndLineNo(result, i)
+                if strEndLineNo is None:
+                    # the rest of the text is inside this string
+                    if result.quoteDanger:
+                        raise error(result, ERROR_QUOTE_DANGER)
+                    raise error(result, ERROR_UNCLOSED_QUOTE)
+        else:
+            finalizeResult(result)
     except ParinferError as e:
+        if result.lineEdits is not None:
+            commitLineEdits(result)
         errorDetails = e.args[0]
         if 'leadingCloseParen' in errorDetails or 'releaseCursorHold' in errorDetails:
             assert mode != PAREN_MODE
-            return processText(text, options, PAREN_MODE, smart)
+            return processText(text, options, PAREN_MODE, smart, result, getParenResume(result, parenResume))
         processError(result, errorDetails)
 
     return result
 
+#-------------------------------------------------------------------------------
+# Streaming
+#-------------------------------------------------------------------------------
+
+# Instead of splitting one big text, we can process lines as they are read and
+# hand back each output line as soon as it is final.  Only the current paren
+# trail line can still be edited by later lines (when correcting or appending
+# to the paren trail), so every line above it is final.
+
+class LineWindow(object):
+    """Output lines indexed by line number, forgetting the ones already handed out."""
+    __slots__ = ('offset', 'lines')
+    def __init__(self):
+        self.offset = 0     # [integer] - line number of lines[0]
+        self.lines = []     # [string array] - output lines not yet handed out
+
+    def __len__(self):
+        return self.offset + len(self.lines)
+
+    def __getitem__(self, lineNo):
+        return self.lines[lineNo - self.offset]
+
+    def __setitem__(self, lineNo, line):
+        self.lines[lineNo - self.offset] = line
+
+    def append(self, line):
+        self.lines.append(line)
+
+    def popUntil(self, lineNo):
+        count = lineNo - self.offset
+        popped = self.lines[:count]
+        del self.lines[:count]
+        self.offset += len(popped)
+        return popped
+
+def stripLineEnding(line):
+    if line.endswith("\r\n"):
+        return line[:-2], "\r\n"
+    if line.endswith(NEWLINE):
+        return line[:-1], NEWLINE
+    return line, None
+
+class ParinferStream(object):
+    """Iterates over the output lines of Indent or Paren Mode for an iterable of
+    input lines (e.g. a file object), holding only a few lines in memory.
+
+    Each input line may include its line ending.  If the last one does, an empty
+    line follows it, just like splitting the whole text would produce.  Output
+    lines include the line ending of the first input line, except the last one.
+
+    After the iteration is exhausted, `success` and `error` describe the result
+    the same way `processText` does.  When `success` is False, the lines
+    already yielded are not valid output and should be discarded.
+
+    Smart Mode may fall back to Paren Mode and change any line, so with `smart`
+    all input lines are read before the first output line is yielded.
+    """
+    __slots__ = ('inputLines', 'mode', 'smart', 'options', 'lineEnding',
+                 'success', 'error', 'cursorX', 'cursorLine')
+
+    def __init__(self, inputLines, options, mode, smart=False):
+        self.inputLines = inputLines
+        self.mode = mode
+        self.smart = smart
+        self.options = options
+        self.lineEnding = None  # [string] - line ending to output (taken from the first line if None)
+        self.success = None     # [boolean] - set once iteration is done
+        self.error = None       # [object] - same as `result.error` when not successful
+        self.cursorX = None     # [integer] - cursor position after processing
+        self.cursorLine = None
+
+    def __iter__(self):
+        if self.smart:
+            yield from self.iterWholeText()
+            return
+
+        options = dict(self.options) if isinstance(self.options, dict) else {}
+        options['returnParens'] = False
+        result = Result('', options, self.mode, False)
+        result.inputLines = {}
+        result.lines = LineWindow()
+        self.cursorX = result.cursorX
+        self.cursorLine = result.cursorLine
+
+        lineEnding = self.lineEnding
+        lineNo = 0
+        try:
+            expectLine = True
+            for line in self.inputLines:
+                line, ending = stripLineEnding(line)
+                if lineEnding is None:
+                    lineEnding = ending
+                expectLine = ending is not None
+
+                result.inputLineNo = lineNo
+                result.inputLines[lineNo] = line
+                processLine(result, lineNo)
+                del result.inputLines[lineNo]
+                lineNo += 1
+
+                # only the last remembered paren trail may still be updated
+                del result.parenTrails[:-1]
+
+                finalLineNo = result.lineNo
+                if result.parenTrail.lineNo is not None:
+                    finalLineNo = min(finalLineNo, result.parenTrail.lineNo)
+                for outLine in result.lines.popUntil(finalLineNo):
+                    yield outLine + (lineEnding or NEWLINE)
+
+            if expectLine:
+                result.inputLineNo = lineNo
+                result.inputLines[lineNo] = ''
+                processLine(result, lineNo)
+
+            finalizeResult(result)
+        except ParinferError as e:
+            processError(result, e.args[0])
+            self.success = False
+            self.error = result.error
+            return
+
+        remaining = result.lines.popUntil(len(result.lines))
+        for outLine in remaining[:-1]:
+            yield outLine + (lineEnding or NEWLINE)
+        yield remaining[-1]
+
+        self.success = True
+        self.cursorX = result.cursorX
+        self.cursorLine = result.cursorLine
+
+    def iterWholeText(self):
+        lineEnding = self.lineEnding
+        lines = []
+        expectLine = True
+        for line in self.inputLines:
+            line, ending = stripLineEnding(line)
+            if lineEnding is None:
+                lineEnding = ending
+            expectLine = ending is not None
+            lines.append(line)
+        if expectLine:
+            lines.append('')
+
+        options = dict(self.options) if isinstance(self.options, dict) else {}
+        options['returnParens'] = False
+        result = processText(NEWLINE.join(lines), options, self.mode, self.smart)
+        if not result.success:
+            self.success = False
+            self.error = result.error
+            return
+
+        for outLine in result.lines[:-1]:
+            yield outLine + (lineEnding or NEWLINE)
+        yield result.lines[-1]
+
+        self.success = True
+        self.cursorX = result.cursorX
+        self.cursorLine = result.cursorLine
+
+    def write(self, outFile):
+        """Writes the output lines to a file object, returning `success`."""
+        for line in self:
+            outFile.write(line)
+        return self.success
+
+#-------------------------------------------------------------------------------
+# Bytes and files
+#-------------------------------------------------------------------------------
+
+# For UTF-8 encoded buffers (bytes, bytearray, memoryview or mmap) we find the
+# lines in the raw bytes and only decode one line at a time.  Output lines are
+# compared against their input lines, so we only keep (and write) the regions
+# that actually changed.  The `x` positions we report are still in characters,
+# the same as for text.
+
+NEWLINE_BYTES_REGEX = re.compile(b"\n")
+CR_BYTES_REGEX = re.compile(b"\r")
+
+class BufferEdits(object):
+    """The changed regions of a buffer after processing it."""
+    __slots__ = ('patches', 'tailStart', 'tail')
+    def __init__(self):
+        self.patches = []       # [array of (start, bytes)] - same-length replacements before `tailStart`
+        self.tailStart = None   # [integer] - byte offset from which everything is replaced by `tail`
+        self.tail = []          # [bytes array] - replacement for data[tailStart:]
+
+def iterBufferLines(data):
+    """Yields (start, end, line) for each line of the buffer, without its line ending."""
+    start = 0
+    for match in NEWLINE_BYTES_REGEX.finditer(data):
+        end = match.start()
+        lineEnd = end - 1 if end > start and data[end-1:end] == b"\r" else end
+        yield start, end + 1, str(data[start:lineEnd], 'utf-8')
+        start = end + 1
+    yield start, len(data), str(data[start:], 'utf-8')
+
+def processBuffer(data, mode, options, smart=False):
+    lineStarts = collections.deque()
+    def inputLines():
+        for start, end, line in iterBufferLines(data):
+            lineStarts.append((start, end))
+            yield line
+
+    lines = inputLines()
+    stream = ParinferStream(lines, options, mode, smart)
+    stream.lineEnding = "\r\n" if CR_BYTES_REGEX.search(data) else NEWLINE
+
+    edits = BufferEdits()
+    try:
+        for outLine in stream:
+            start, end = lineStarts.popleft()
+            outBytes = outLine.encode('utf-8')
+            if edits.tailStart is not None:
+                edits.tail.append(outBytes)
+            elif outBytes != data[start:end]:
+                if len(outBytes) == end - start:
+                    edits.patches.append((start, outBytes))
+                else:
+                    edits.tailStart = start
+                    edits.tail.append(outBytes)
+    finally:
+        # release our view of the buffer (needed before an mmap can be closed)
+        lines.close()
+    return stream, edits
+
+def bufferResult(stream, edits):
+    final = {
+        'success': stream.success,
+        'changed': bool(stream.success and (edits.patches or edits.tailStart is not None))
+    }
+    if stream.success:
+        if stream.cursorX is not None:
+            final['cursorX'] = stream.cursorX
+        if stream.cursorLine is not None:
+            final['cursorLine'] = stream.cursorLine
+    else:
+        final['error'] = stream.error
+    return final
+
+def writeBufferEdits(outFile, data, edits):
+    """Writes `data` with `edits` applied to a binary file object."""
+    pos = 0
+    for start, patch in edits.patches:
+        outFile.write(data[pos:start])
+        outFile.write(patch)
+        pos = start + len(patch)
+    if edits.tailStart is not None:
+        outFile.write(data[pos:edits.tailStart])
+        for chunk in edits.tail:
+            outFile.write(chunk)
+    else:
+        outFile.write(data[pos:])
+
+def patchBufferEdits(f, edits):
+    """Writes only the changed regions back into the file object `data` was read from."""
+    for start, patch in edits.patches:
+        f.seek(start)
+        f.write(patch)
+    if edits.tailStart is not None:
+        f.seek(edits.tailStart)
+        for chunk in edits.tail:
+            f.write(chunk)
+        f.truncate()
+
+def applyBufferEdits(data, edits):
+    if not edits.patches and edits.tailStart is None:
+        return data if isinstance(data, bytes) else bytes(data)
+    chunks = []
+    pos = 0
+    for start, patch in edits.patches:
+        chunks.append(data[pos:start])
+        chunks.append(patch)
+        pos = start + len(patch)
+    if edits.tailStart is not None:
+        chunks.append(data[pos:edits.tailStart])
+        chunks.extend(edits.tail)
+    else:
+        chunks.append(data[pos:])
+    return b''.join(chunks)
+
+#-------------------------------------------------------------------------------
+# Result cache
+#-------------------------------------------------------------------------------
+
+# An opt-in LRU cache in front of `indent_mode`, `paren_mode` and `smart_mode`
+# (see `enable_result_cache`).  Entries are keyed by a hash of the text plus
+# the mode and the options that affect the result, and evicted by entry count
+# and by an estimate of their size in bytes.  Results are deep-copied going
+# in and out so callers never share mutable state with the cache.
+
+# options that do not change the result (`cancelToken` only stops the work)
+UNCACHED_OPTIONS = frozenset(['cancelToken'])
+
+# options whose results we do not cache (they carry state from/for another call)
+UNCACHEABLE_OPTIONS = frozenset(['checkpoints', 'returnCheckpoints', 'editRange',
+                                 'deadline', 'budget', 'continuation'])
+
+def makeCacheKey(text, options, mode, smart):
+    import hashlib
+    import json
+
+    optionsKey = None
+    if isinstance(options, dict):
+        if not UNCACHEABLE_OPTIONS.isdisjoint(options):
+            return None
+        try:
+            optionsKey = json.dumps({k: v for k, v in options.items() if k not in UNCACHED_OPTIONS},
+                                    sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+    digest = hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=20).digest()
+    return (digest, len(text), mode, smart, optionsKey)
+
+def estimateResultSize(text, final):
+    size = len(text) + len(final.get('text') or '')
+    for key in ('parenTrails', 'tabStops', 'parens'):
+        if final.get(key):
+            size += 100 * len(final[key])
+    return size
+
+class ResultCache(object):
+    """A thread-safe LRU cache of public results."""
+    __slots__ = ('maxEntries', 'maxBytes', 'entries', 'size', 'lock',
+                 'hits', 'misses', 'evictions')
+
+    def __init__(self, maxEntries=1024, maxBytes=64*1024*1024):
+        import threading
+
+        self.maxEntries = maxEntries    # [integer] - maximum number of cached results
+        self.maxBytes = maxBytes        # [integer] - maximum estimated size of all cached results
+        self.entries = collections.OrderedDict()  # maps key to (result, size), least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    copyEntries = True
+
+    def get(self, key):
+        import copy
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(entry[0]) if self.copyEntries else entry[0]
+
+    def estimateSize(self, text, final):
+        return estimateResultSize(text, final)
+
+    def put(self, key, text, final):
+        import copy
+
+        size = self.estimateSize(text, final)
+        if size > self.maxBytes:
+            return
+        if self.copyEntries:
+            final = copy.deepcopy(final)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (final, size)
+            self.size += size
+            while len(self.entries) > self.maxEntries or self.size > self.maxBytes:
+                oldKey, (oldFinal, oldSize) = self.entries.popitem(last=False)
+                self.size -= oldSize
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def process(self, text, options, mode, smart):
+        key = makeCacheKey(text, options, mode, smart)
+        if key is not None:
+            final = self.get(key)
+            if final is not None:
+                return final
+        final = processPublic(text, options, mode, smart)
+        if key is not None:
+            self.put(key, text, final)
+        return final
+
+resultCache = None
+
+def enable_result_cache(maxEntries=1024, maxBytes=64*1024*1024):
+    """Puts a new ResultCache in front of the mode functions and returns it."""
+    global resultCache
+    resultCache = ResultCache(maxEntries, maxBytes)
+    return resultCache
+
+def disable_result_cache():
+    global resultCache
+    resultCache = None
+
+#-------------------------------------------------------------------------------
+# Line cache
+#-------------------------------------------------------------------------------
+
+# An opt-in cache of line transitions (see `enable_line_cache`) for inputs that
+# repeat the same lines over and over, like large data files.
+#
+# Without the cursor, selection, changes or returnParens options, processing a
+# line only depends on its text and the state it starts in, and the line
+# numbers in that state are never read.  So we key a line by its text and its
+# entering state minus those line numbers, record what processing it did to
+# the state and the output, and replay that the next time the same key comes
+# up instead of processing the line's characters again.
+#
+# A transition refers to the openers it started with by their position in the
+# paren stack or paren trail, so replaying it keeps their identity (and their
+# line numbers).  Lines that start or end with a live cached error position
+# (e.g. inside a multi-line string) are not cached.
+#
+# Recording a line costs more than processing it, so we stop using the cache
+# for the rest of a text whose first lines rarely repeat (e.g. regular code).
+
+LINE_CACHE_PROBE_LINES = 64
+LINE_CACHE_MIN_HITS = 16
+
+def canCacheLines(result):
+    return (not result.stopOnChange and
+            result.cursorX is None and result.cursorLine is None and
+            result.prevCursorLine is None and result.selectionStartLine is None and
+            result.changes is None and not result.returnParens and
+            result.checkpoints is None)
+
+def hasLiveErrorPos(result):
+    # the quote errors are cached whenever a string or a commented quote
+    # starts, and only read while it lasts
+    for name in result.errorPosCache:
+        if name == ERROR_UNCLOSED_QUOTE and not result.isInStr:
+            continue
+        if name == ERROR_QUOTE_DANGER and not result.quoteDanger:
+            continue
+        return True
+    return False
+
+def snapshotOpenerFields(opener):
+    return (opener.x, opener.ch, opener.indentDelta, opener.maxChildIndent, opener.argX)
+
+def getLineKey(result, line, lineNo):
+    trail = result.parenTrail
+    trailKey = None
+    lastTrail = None
+    if trail.lineNo is not None:
+        trailKey = (trail.lineNo - lineNo, trail.startX, trail.endX,
+                    tuple(snapshotOpenerFields(o) for o in trail.openers),
+                    result.lines[trail.lineNo])
+        if result.parenTrails and result.parenTrails[-1]['lineNo'] == trail.lineNo:
+            lastTrail = (result.parenTrails[-1]['startX'], result.parenTrails[-1]['endX'])
+    return (getOptionsKey(result), line,
+            result.isInCode, result.isEscaping, result.isEscaped,
+            result.isInStr, result.isInComment, result.quoteDanger, result.maxIndent,
+            tuple(snapshotOpenerFields(o) for o in result.parenStack),
+            trailKey, lastTrail, result.parenIndentStable)
+
+class LineTransition(object):
+    __slots__ = ('line', 'changed', 'trailLine', 'stackStart', 'stack', 'newOpeners', 'trail',
+                 'state', 'lastTrailEndX', 'parenTrails')
+
+    def __init__(self):
+        self.line = None            # [string] - output line
+        self.changed = False        # [boolean] - did the line change the output line or the paren trail line
+        self.trailLine = None       # [string] - new text of the entering paren trail line (if it was another line)
+        self.stackStart = 0         # [integer] - length of the paren stack prefix that was left untouched
+        self.stack = None           # [tuple] - refs to the rest of the paren stack (see `recordLine`)
+        self.newOpeners = None      # [tuple] - snapshots of openers created by the line, with relative line numbers
+        self.trail = None           # [tuple] - (relative lineNo, startX, endX, refs to openers) of the paren trail
+        self.state = None           # [tuple] - flags and positions after the line (see `recordLine`)
+        self.lastTrailEndX = None   # [integer] - new endX of the last remembered paren trail (if it was extended)
+        self.parenTrails = None     # [tuple] - (relative lineNo, startX, endX) of the paren trails remembered by the line
+
+def recordLine(result, lineNo, key, stack, trailOpeners, trailLineNo, trailsLen, trailLine):
+    """Describes what processing a line did, or returns None if it can't be replayed."""
+    trail = result.parenTrail
+    if (result.errorPosCache and hasLiveErrorPos(result) or
+            trail.clamped.startX is not None or trail.clamped.openers):
+        return None
+
+    refs = {}
+    for i, opener in enumerate(stack):
+        refs[id(opener)] = ('s', i)
+    for i, opener in enumerate(trailOpeners):
+        refs[id(opener)] = ('t', i)
+    newOpeners = []
+    def ref(opener):
+        r = refs.get(id(opener))
+        if r is None:
+            r = refs[id(opener)] = ('n', len(newOpeners))
+            newOpeners.append((opener.inputLineNo - lineNo, opener.inputX, opener.lineNo - lineNo)
+                              + snapshotOpenerFields(opener))
+        return r + (snapshotOpenerFields(opener),)
+
+    stackFields = key[9]
+    stackStart = 0
+    for stackStart in range(min(len(stack), len(result.parenStack)) + 1):
+        if (stackStart == len(stack) or stackStart == len(result.parenStack) or
+                result.parenStack[stackStart] is not stack[stackStart] or
+                snapshotOpenerFields(stack[stackStart]) != stackFields[stackStart]):
+            break
+
+    t = LineTransition()
+    t.line = result.lines[lineNo]
+    if trailLineNo is not None and trailLineNo != lineNo:
+        t.trailLine = result.lines[trailLineNo]
+    t.changed = t.line != result.inputLines[lineNo] or t.trailLine != trailLine
+    t.stackStart = stackStart
+    t.stack = tuple(ref(o) for o in result.parenStack[stackStart:])
+    t.trail = (None if trail.lineNo is None else trail.lineNo - lineNo,
+               trail.startX, trail.endX, tuple(ref(o) for o in trail.openers))
+    t.newOpeners = tuple(newOpeners)
+    t.state = (result.isInCode, result.isEscaping, result.isEscaped,
+               result.isInStr, result.isInComment, result.quoteDanger, result.maxIndent,
+               result.x, result.inputX, result.ch, result.indentX, result.commentX,
+               result.indentDelta, result.trackingIndent, result.trackingArgTabStop,
+               result.skipChar, result.parenIndentStable)
+    if key[11] is not None:
+        t.lastTrailEndX = result.parenTrails[trailsLen-1]['endX']
+    t.parenTrails = tuple((p['lineNo'] - lineNo, p['startX'], p['endX'])
+                          for p in result.parenTrails[trailsLen:])
+    return t
+
+def replayLine(result, lineNo, t):
+    initLine(result)
+    result.lines.append(t.line)
+    if t.changed:
+        result.changed = True
+    trail = result.parenTrail
+    if t.trailLine is not None:
+        result.lines[trail.lineNo] = t.trailLine
+
+    stack = result.parenStack
+    trailOpeners = trail.openers
+    newOpeners = []
+    for s in t.newOpeners:
+        opener = Opener(s[0] + lineNo, s[1], s[2] + lineNo, s[3], s[4], s[5], s[6])
+        opener.argX = s[7]
+        newOpeners.append(opener)
+    def resolve(ref):
+        kind, i, fields = ref
+        if kind == 'n':
+            return newOpeners[i]
+        opener = stack[i] if kind == 's' else trailOpeners[i]
+        opener.x, opener.ch, opener.indentDelta, opener.maxChildIndent, opener.argX = fields
+        return opener
+    restStack = [resolve(r) for r in t.stack]
+    trailLineNo, trail.startX, trail.endX, openerRefs = t.trail
+    trail.openers = [resolve(r) for r in openerRefs]
+    trail.lineNo = None if trailLineNo is None else trailLineNo + lineNo
+    del stack[t.stackStart:]
+    stack.extend(restStack)
+    if not result.shiftedOpeners:
+        result.shiftedOpeners = hasShiftedOpener(restStack) or hasShiftedOpener(trail.openers)
+
+    (result.isInCode, result.isEscaping, result.isEscaped,
+     result.isInStr, result.isInComment, result.quoteDanger, result.maxIndent,
+     result.x, result.inputX, result.ch, result.indentX, result.commentX,
+     result.indentDelta, result.trackingIndent, result.trackingArgTabStop,
+     result.skipChar, result.parenIndentStable) = t.state
+    if t.lastTrailEndX is not None:
+        result.parenTrails[-1]['endX'] = t.lastTrailEndX
+    for relLineNo, startX, endX in t.parenTrails:
+        result.parenTrails.append({'lineNo': relLineNo + lineNo, 'startX': startX, 'endX': endX})
+
+class LineCache(ResultCache):
+    """A thread-safe LRU cache of line transitions."""
+    __slots__ = ()
+
+    copyEntries = False  # transitions are never modified once recorded
+
+    def estimateSize(self, text, transition):
+        return 2 * (len(text) + len(transition.line)) + 200
+
+    def processLine(self, result, lineNo):
+        if lineNo == LINE_CACHE_PROBE_LINES and result.lineCacheHits < LINE_CACHE_MIN_HITS:
+            result.lineCache = None
+            processLineChars(result, lineNo)
+            return
+        trail = result.parenTrail
+        if result.errorPosCache and hasLiveErrorPos(result) or trail.clamped.startX is not None:
+            processLineChars(result, lineNo)
+            return
+        line = result.inputLines[lineNo]
+        key = getLineKey(result, line, lineNo)
+        transition = self.get(key)
+        if transition is not None:
+            replayLine(result, lineNo, transition)
+            result.lineCacheHits += 1
+            return
+
+        stack = list(result.parenStack)
+        trailOpeners = list(trail.openers)
+        trailLineNo = trail.lineNo
+        trailLine = key[10] and key[10][4]
+        trailsLen = len(result.parenTrails)
+        processLineChars(result, lineNo)
+        transition = recordLine(result, lineNo, key, stack, trailOpeners, trailLineNo, trailsLen, trailLine)
+        if transition is not None:
+            self.put(key, line, transition)
+
+lineCache = None
+
+def enable_line_cache(maxEntries=4096, maxBytes=16*1024*1024):
+    """Replays repeated lines from a new LineCache and returns it."""
+    global lineCache
+    lineCache = LineCache(maxEntries, maxBytes)
+    return lineCache
+
+def disable_line_cache():
+    global lineCache
+    lineCache = None
+
 #-------------------------------------------------------------------------------
 # Public API
 #-------------------------------------------------------------------------------
 
+def diffLine(oldLine, newLine, lineNo, offset, edits):
+    prefix = commonPrefixLength(oldLine, newLine)
+    if prefix == len(oldLine) == len(newLine):
+        return
+    suffix = commonPrefixLength(oldLine[prefix:][::-1], newLine[prefix:][::-1])
+    edits.append({
+        'lineNo': lineNo,
+        'startX': offset + prefix,
+        'endX': offset + len(oldLine) - suffix,
+        'replacement': newLine[prefix:len(newLine)-suffix]
+    })
+
+def makeEdits(result):
+    """Returns the edits that turn the input lines into the output lines, and
+    the numbers of the lines they change."""
+    edits = []
+    changedLines = []
+    for lineNo, (inputLine, line) in enumerate(zip(result.inputLines, result.lines)):
+        if inputLine is line or inputLine == line:
+            continue
+        changedLines.append(lineNo)
+        # indentation and paren trails usually change independently
+        inputIndent = len(inputLine) - len(inputLine.lstrip(BLANK_SPACE))
+        indent = len(line) - len(line.lstrip(BLANK_SPACE))
+        if inputIndent == indent:
+            diffLine(inputLine, line, lineNo, 0, edits)
+        else:
+            diffLine(inputLine[:inputIndent], line[:indent], lineNo, 0, edits)
+            diffLine(inputLine[inputIndent:], line[indent:], lineNo, inputIndent, edits)
+    return edits, changedLines
+
+def getOutputText(result):
+    """Joins the output lines, or returns the input text itself if they are
+    the same lines with the same line endings."""
+    text = result.origText
+    if (not result.changed and len(result.lines) == len(result.inputLines) and
+            ('\r' not in text or text.count('\r\n') == text.count('\n'))):
+        return text
+    return getLineEnding(text).join(result.lines)
+
 def publicResult(result):
-    lineEnding = getLineEnding(result.origText)
+    if result.stopLineNo is not None:
+        return publicPartialResult(result)
     if result.success:
         final = {
-            'text': lineEnding.join(result.lines),
+            'text': getOutputText(result) if result.returnText else None,
             'cursorX': result.cursorX,
             'cursorLine': result.cursorLine,
             'success': True,
@@ -1389,7 +2768,8 @@ def publicResult(result):
             final['parens'] = result.parens
     else:
         final = {
-            'text': lineEnding.join(result.lines) if result.partialResult else result.origText,
+            'text': (getOutputText(result) if result.partialResult else result.origText)
+                    if result.returnText else None,
             'cursorX': result.cursorX if result.partialResult else result.origCursorX,
             'cursorLine': result.cursorLine if result.partialResult else result.origCursorLine,
             'parenTrails': result.parenTrails if result.partialResult else None,
@@ -1405,19 +2785,719 @@ def publicResult(result):
         del final['cursorLine']
     if 'tabStops' in final and len(final['tabStops']) == 0:
         del final['tabStops']
+    if final['text'] is None:
+        del final['text']
+        final['changed'] = ((result.success or result.partialResult) and result.changed and
+                            result.lines != result.inputLines)
+    else:
+        final['changed'] = final['text'] is not result.origText and final['text'] != result.origText
+    if result.returnEdits:
+        if result.success or result.partialResult:
+            final['edits'], final['changedLines'] = makeEdits(result)
+        else:
+            final['edits'], final['changedLines'] = [], []
+    if result.checkpoints is not None:
+        final['checkpoints'] = makeCheckpoints(result)
+    if result.fallbackLineNo is not None:
+        final['fallbackLineNo'] = result.fallbackLineNo
     return final
 
+def processPublic(text, options, mode, smart=False):
+    if formCache is not None:
+        return formCache.process(text, options, mode, smart)
+    return publicResult(processText(text, options, mode, smart))
+
 def indent_mode(text, options):
-    return publicResult(processText(text, options, INDENT_MODE))
+    if resultCache is not None:
+        return resultCache.process(text, options, INDENT_MODE, False)
+    return processPublic(text, options, INDENT_MODE)
 
 def paren_mode(text, options):
-    return publicResult(processText(text, options, PAREN_MODE))
+    if resultCache is not None:
+        return resultCache.process(text, options, PAREN_MODE, False)
+    return processPublic(text, options, PAREN_MODE)
 
 def smart_mode(text, options):
     smart = False
     if isinstance(options, dict):
         smart = 'selectionStartLine' not in options or options['selectionStartLine'] is None
-    return publicResult(processText(text, options, INDENT_MODE, smart))
+    if resultCache is not None:
+        return resultCache.process(text, options, INDENT_MODE, smart)
+    return processPublic(text, options, INDENT_MODE, smart)
+
+def findMixedLineEnding(text):
+    """Returns the (lineNo, x) of the first line ending that differs from
+    `getLineEnding(text)`, or None."""
+    if '\r' not in text or text.count('\r\n') == text.count('\n'):
+        return None
+    i = text.find('\n')
+    while i > 0 and text[i-1] == '\r':
+        i = text.find('\n', i + 1)
+    return text.count('\n', 0, i), i - (text.rfind('\n', 0, i) + 1)
+
+def is_stable(text, mode='paren', options=None):
+    """Checks if `mode` would leave `text` unchanged without building its
+    output, stopping at the first edit it finds.  Returns a dict with 'stable'
+    and, if it is not, the 'lineNo' and 'x' of that edit (or of the 'error'
+    that `mode` would return).  Closers moved onto the previous line's paren
+    trail are only found after that line, so an earlier line may change too."""
+    options = dict(options) if isinstance(options, dict) else {}
+    processMode, smart = getModeArgs(mode, options)
+    options['stopOnChange'] = True
+    for key in ('returnParens', 'returnCheckpoints', 'checkpoints', 'partialResult'):
+        options.pop(key, None)
+
+    mixed = findMixedLineEnding(text)
+    try:
+        result = processText(text, options, processMode, smart)
+    except LineChanged as e:
+        if smart:
+            # smart mode may still fall back to paren mode and drop this edit
+            del options['stopOnChange']
+            result = processText(text, options, processMode, smart)
+            edits = makeEdits(result)[0] if result.success else None
+            e = LineChanged(edits[0]['lineNo'], edits[0]['startX']) if edits else None
+        if e is not None:
+            if mixed is not None and mixed[0] < e.lineNo:
+                return {'stable': False, 'lineNo': mixed[0], 'x': mixed[1]}
+            return {'stable': False, 'lineNo': e.lineNo, 'x': e.x}
+    if not result.success:
+        return {'stable': False, 'lineNo': result.error['lineNo'], 'x': result.error['x'],
+                'error': result.error}
+    if mixed is not None:
+        return {'stable': False, 'lineNo': mixed[0], 'x': mixed[1]}
+    return {'stable': True}
+
+def iter_indent_mode(lines, options=None):
+    return ParinferStream(lines, options, INDENT_MODE)
+
+def iter_paren_mode(lines, options=None):
+    return ParinferStream(lines, options, PAREN_MODE)
+
+def process_bytes(data, mode=PAREN_MODE, options=None, smart=False):
+    """Runs Indent, Paren or (with `smart`) Smart Mode over a UTF-8 buffer
+    (bytes, bytearray, memoryview or mmap).  The result has the output as bytes
+    in 'text' (the same object if `data` is unchanged bytes) and a 'changed' flag."""
+    stream, edits = processBuffer(data, mode, options, smart)
+    final = bufferResult(stream, edits)
+    final['text'] = applyBufferEdits(data, edits) if stream.success else data
+    return final
+
+def process_file(path, mode=PAREN_MODE, options=None, smart=False, inPlace=False):
+    """Runs Indent, Paren or (with `smart`) Smart Mode over a UTF-8 file.
+    Files that are already formatted are not written.  A changed file is
+    replaced by a complete new copy, so an interruption cannot leave it half
+    written.  With `inPlace`, only the regions that changed are written back
+    into the file itself, which is faster for large files with small changes
+    but not safe to interrupt."""
+    import mmap
+    import tempfile
+
+    with open(path, 'r+b' if inPlace else 'rb') as f:
+        data = b''
+        if f.seek(0, 2) != 0:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        tempPath = None
+        try:
+            stream, edits = processBuffer(data, mode, options, smart)
+            final = bufferResult(stream, edits)
+            if final['changed'] and not inPlace:
+                with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)),
+                                                 prefix='.' + os.path.basename(path) + '.',
+                                                 delete=False) as out:
+                    tempPath = out.name
+                    writeBufferEdits(out, data, edits)
+                os.chmod(tempPath, os.stat(f.fileno()).st_mode & 0o7777)
+        except BaseException:
+            if tempPath is not None:
+                os.unlink(tempPath)
+            raise
+        finally:
+            if not isinstance(data, bytes):
+                data.close()
+
+        if final['changed'] and inPlace:
+            patchBufferEdits(f, edits)
+
+    if tempPath is not None:
+        os.replace(tempPath, path)
+    return final
+
+def commonPrefixLength(a, b):
+    # binary search on slice equality keeps the comparisons in C
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def getEditRange(oldText, newText):
+    """Returns the `editRange` option describing which lines differ between two texts."""
+    numLines = newText.count('\n') + 1
+    if oldText == newText:
+        # nothing edited: only the cursor lines need to be processed again
+        return {'lineNo': numLines, 'oldEndLineNo': -1, 'newEndLineNo': -1}
+
+    prefix = commonPrefixLength(oldText, newText)
+    maxSuffix = min(len(oldText), len(newText)) - prefix
+    suffix = commonPrefixLength(oldText[:-maxSuffix-1:-1] if maxSuffix else '',
+                                newText[:-maxSuffix-1:-1] if maxSuffix else '')
+    return {
+        'lineNo': newText.count('\n', 0, prefix),
+        'oldEndLineNo': oldText.count('\n', 0, len(oldText) - suffix),
+        'newEndLineNo': newText.count('\n', 0, len(newText) - suffix),
+    }
+
+MODE_FNS = {
+    'indent': indent_mode,
+    'paren': paren_mode,
+    'smart': smart_mode,
+}
+
+def copyResult(final):
+    """Copies the lists and objects in a public result that a caller may
+    modify, leaving out opaque objects like `checkpoints`."""
+    import copy
+
+    final = dict(final)
+    for key in ('tabStops', 'parenTrails', 'edits'):
+        if final.get(key) is not None:
+            final[key] = [dict(x) for x in final[key]]
+    if final.get('changedLines') is not None:
+        final['changedLines'] = list(final['changedLines'])
+    for key in ('error', 'parens'):
+        if final.get(key) is not None:
+            final[key] = copy.deepcopy(final[key])
+    return final
+
+class ParinferSession(object):
+    """Processes successive versions of one buffer, e.g. from an editor's
+    keystroke and cursor-move events.
+
+    Identical inputs return the previous result.  Otherwise the previous
+    run's checkpoints are reused so that only the edited lines and the
+    lines around the old and new cursor are processed again.
+    """
+    __slots__ = ('mode', 'text', 'options', 'result', 'checkpoints')
+
+    def __init__(self, mode='smart'):
+        self.mode = mode            # [string] - 'indent', 'paren' or 'smart'
+        self.text = None            # [string] - last input text
+        self.options = None         # [object] - last options
+        self.result = None          # [object] - last public result
+        self.checkpoints = None     # [Checkpoints] - snapshots from the last run
+
+    def process(self, text, options=None):
+        options = dict(options) if options else {}
+        if self.result is not None and text == self.text and options == self.options:
+            return copyResult(self.result)
+
+        runOptions = dict(options)
+        if self.checkpoints is not None:
+            runOptions['checkpoints'] = self.checkpoints
+            runOptions['editRange'] = getEditRange(self.text, text)
+        else:
+            runOptions['returnCheckpoints'] = True
+
+        result = MODE_FNS[self.mode](text, runOptions)
+        self.checkpoints = result.get('checkpoints')
+        if not options.get('returnCheckpoints'):
+            result.pop('checkpoints', None)
+
+        self.text = text
+        self.options = options
+        self.result = result
+        return copyResult(result)
+
+#-------------------------------------------------------------------------------
+# asyncio
+#-------------------------------------------------------------------------------
+
+# The async functions run the processing in an executor (the event loop's
+# default thread pool unless one is given) so the event loop is not blocked.
+# Calls that pass the same `bufferId` coalesce: a new call cancels the
+# previous one, which stops between lines and raises asyncio.CancelledError
+# to its caller, so only the latest text of each buffer is worked on.
+
+latestCancelTokens = {}  # maps bufferId to the CancelToken of its latest call
+
+async def processAsync(fn, text, options, bufferId, executor):
+    import asyncio
+
+    token = CancelToken()
+    if bufferId is not None:
+        prevToken = latestCancelTokens.get(bufferId)
+        if prevToken is not None:
+            prevToken.cancel()
+        latestCancelTokens[bufferId] = token
+
+    options = dict(options) if options else {}
+    options['cancelToken'] = token
+    loop = asyncio.get_running_loop()
+    try:
+        final = await loop.run_in_executor(executor, fn, text, options)
+    except ParinferCancelled:
+        raise asyncio.CancelledError()
+    except asyncio.CancelledError:
+        token.cancel()
+        raise
+    finally:
+        if bufferId is not None and latestCancelTokens.get(bufferId) is token:
+            del latestCancelTokens[bufferId]
+
+    if token.cancelled:
+        # superseded after the work had already finished
+        raise asyncio.CancelledError()
+    return final
+
+async def indent_mode_async(text, options=None, bufferId=None, executor=None):
+    return await processAsync(indent_mode, text, options, bufferId, executor)
+
+async def paren_mode_async(text, options=None, bufferId=None, executor=None):
+    return await processAsync(paren_mode, text, options, bufferId, executor)
+
+async def smart_mode_async(text, options=None, bufferId=None, executor=None):
+    return await processAsync(smart_mode, text, options, bufferId, executor)
+
+#-------------------------------------------------------------------------------
+# Batch processing
+#-------------------------------------------------------------------------------
+
+# `batch` runs many documents through a process pool.  Items are sent to the
+# workers in chunks (to amortize the pickling round-trip), and only a bounded
+# number of chunks are in flight so that huge inputs are not all submitted at
+# once.  Results are plain dicts, and `parens` are only included when
+# `returnParens` is requested, so they are cheap to send back.  An item that
+# cannot be processed at all (e.g. a file that is not UTF-8) gets a failed
+# result with its exception instead of stopping the whole batch.
+
+BATCH_CHUNK_SIZE = 8
+BATCH_CHUNKS_PER_WORKER = 4
+
+def processBatchItem(item, mode, options, write):
+    if not isinstance(item, os.PathLike):
+        return MODE_FNS[mode](item, None if options is None else dict(options))
+
+    # files: never send the text back, just whether it changed
+    fileMode, smart = getModeArgs(mode, options or {})
+    if options is None:
+        smart = False  # the same as smart_mode(text, None)
+    if write:
+        return process_file(item, fileMode, options, smart)
+    with open(item, 'rb') as f:
+        final = process_bytes(f.read(), fileMode, options, smart)
+    del final['text']
+    return final
+
+def batchItemError(item, e):
+    import pickle
+
+    try:
+        pickle.dumps(e)
+    except Exception:
+        e = RuntimeError(repr(e))  # it still has to reach the parent process
+    return {
+        'success': False,
+        'error': {
+            'name': 'exception',
+            'message': str(e),
+            'path': os.fspath(item) if isinstance(item, os.PathLike) else None,
+            'exception': e,
+        },
+    }
+
+def processBatchChunk(chunk, mode, options, write):
+    finals = []
+    for i, item in chunk:
+        try:
+            final = processBatchItem(item, mode, options, write)
+        except Exception as e:
+            final = batchItemError(item, e)
+        finals.append((i, final))
+    return finals
+
+def batch(items, mode='paren', options=None, workers=None, ordered=True,
+          write=False, chunkSize=BATCH_CHUNK_SIZE):
+    """Processes many texts or files on a process pool.
+
+    `items` may mix texts (str) and files (os.PathLike, e.g. pathlib.Path).
+    Texts get the same result as `mode` ('indent', 'paren' or 'smart') would
+    return.  Files get a result without 'text' but with a 'changed' flag, and
+    are rewritten in place if `write` is set.
+
+    An item that raises gets a failed result whose 'error' has the name
+    'exception', the item's 'path' (None for texts) and the 'exception'.
+
+    With `ordered`, results are yielded in input order.  Otherwise (index,
+    result) pairs are yielded as soon as they are done.  `workers=1` processes
+    everything in this process.
+    """
+    import concurrent.futures
+
+    if mode not in MODE_FNS:
+        raise ValueError("unknown mode: " + str(mode))
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    chunks = iter(lambda it=enumerate(items): list(itertools.islice(it, chunkSize)), [])
+
+    if workers <= 1:
+        for chunk in chunks:
+            for i, final in processBatchChunk(chunk, mode, options, write):
+                yield final if ordered else (i, final)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        maxPending = workers * BATCH_CHUNKS_PER_WORKER
+        pending = collections.deque() if ordered else set()
+
+        def submit():
+            chunk = next(chunks, None)
+            if chunk is None:
+                return False
+            future = executor.submit(processBatchChunk, chunk, mode, options, write)
+            if ordered:
+                pending.append(future)
+            else:
+                pending.add(future)
+            return True
+
+        while len(pending) < maxPending and submit():
+            pass
+
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                pending.difference_update(done)
+
+            for future in done:
+                for i, final in future.result():
+                    yield final if ordered else (i, final)
+                submit()
+
+#-------------------------------------------------------------------------------
+# Partitioned processing
+#-------------------------------------------------------------------------------
+
+# A line starting with an open-paren at column 0 usually begins an independent
+# top-level form, so we can split the text there and process the segments in
+# parallel, then stitch them back together.  Whether a split was really safe is
+# checked afterwards, and we fall back to processing the whole text if not:
+#
+#   - every segment must succeed (a string or an unclosed paren spanning a
+#     boundary shows up as an error in the segment above it) without smart
+#     mode falling back to Paren Mode,
+#   - in Indent Mode, the segment above a boundary must not leave any open-paren
+#     that the boundary line would not close,
+#   - in Paren Mode, a segment is processed assuming that the segment above it
+#     left `maxIndent` at 0 (a closed top-level form at column 0), and is
+#     processed again if that was not the case.
+#
+# Lines that depend on the cursor, selection or changes are never boundaries.
+
+PARTITION_MIN_LINES = 256
+
+def findTopLevelBoundaries(lines, minLines, excludedLineNos):
+    boundaries = [0]
+    for lineNo in range(minLines, len(lines)):
+        if (lineNo - boundaries[-1] >= minLines and
+                lines[lineNo][:1] == '(' and
+                lineNo not in excludedLineNos):
+            boundaries.append(lineNo)
+    return boundaries
+
+def segmentOptions(options, startLineNo, endLineNo):
+    """Translates the line numbers of the options to a segment of lines."""
+    segOptions = {}
+    for key, value in options.items():
+        if key not in ('cursorX', 'cursorLine', 'prevCursorX', 'prevCursorLine',
+                       'selectionStartLine', 'changes'):
+            segOptions[key] = value
+    def inSegment(lineNo):
+        return lineNo is not None and startLineNo <= lineNo < endLineNo
+
+    if inSegment(options.get('cursorLine')):
+        segOptions['cursorLine'] = options['cursorLine'] - startLineNo
+        if 'cursorX' in options:
+            segOptions['cursorX'] = options['cursorX']
+    # the previous cursor is ignored whenever there are changes
+    if inSegment(options.get('prevCursorLine')) and not options.get('changes'):
+        segOptions['prevCursorLine'] = options['prevCursorLine'] - startLineNo
+        if 'prevCursorX' in options:
+            segOptions['prevCursorX'] = options['prevCursorX']
+    if inSegment(options.get('selectionStartLine')):
+        segOptions['selectionStartLine'] = options['selectionStartLine'] - startLineNo
+    changes = []
+    for change in options.get('changes') or []:
+        if inSegment(transformChange(change)['lookupLineNo']):
+            change = dict(change)
+            change['lineNo'] -= startLineNo
+            changes.append(change)
+    if changes:
+        segOptions['changes'] = changes
+    return segOptions
+
+def processSegment(text, options, mode, smart, maxIndent):
+    """Processes one segment, returning None if it cannot be used."""
+    result = Result(text, options, mode, smart)
+    result.maxIndent = maxIndent
+    try:
+        for i in range(len(result.inputLines)):
+            result.inputLineNo = i
+            processLine(result, i)
+        exitMaxIndent = result.maxIndent
+        finalizeResult(result)
+    except ParinferError:
+        return None
+    return {
+        'lines': result.lines,
+        'cursorX': result.cursorX,
+        'cursorLine': result.cursorLine,
+        'tabStops': result.tabStops,
+        'parenTrails': result.parenTrails,
+        'changed': result.changed,
+        'hasOpenParens': len(result.parenStack) != 0,
+        'enterMaxIndent': maxIndent,
+        'maxIndent': exitMaxIndent,
+    }
+
+def canPartition(options):
+    return not (options.get('returnParens') or options.get('partialResult') or
+                not UNCACHEABLE_OPTIONS.isdisjoint(options) or 'cancelToken' in options)
+
+def getModeArgs(mode, options):
+    """Returns the `processText` mode and smart flag for a MODE_FNS name."""
+    if mode not in MODE_FNS:
+        raise ValueError("unknown mode: " + str(mode))
+    if mode == 'paren':
+        return PAREN_MODE, False
+    if mode == 'smart':
+        return INDENT_MODE, options.get('selectionStartLine') is None
+    return INDENT_MODE, False
+
+def partitionText(text, options, minLines):
+    """Returns the lines of `text` and the line numbers where segments start."""
+    lines = splitLines(text)
+    excludedLineNos = set(lineNo for lineNo in (options.get('cursorLine'),
+                                                 options.get('prevCursorLine'),
+                                                 options.get('selectionStartLine'))
+                          if lineNo is not None)
+    for change in options.get('changes') or []:
+        excludedLineNos.add(transformChange(change)['lookupLineNo'])
+    return lines, findTopLevelBoundaries(lines, minLines, excludedLineNos)
+
+def stitchSegments(text, options, mode, smart, boundaries, segments):
+    """Returns the public result for processed segments, or None if one of
+    them failed or a boundary turned out to be unsafe."""
+    if None in segments:
+        return None
+    for segment, nextSegment in zip(segments, segments[1:]):
+        if mode == INDENT_MODE and segment['hasOpenParens']:
+            return None
+        if mode == PAREN_MODE and segment['maxIndent'] != nextSegment['enterMaxIndent']:
+            return None
+
+    result = Result(text, options, mode, smart)
+    result.lines = []
+    tabStopLine = getTabStopLine(result)
+    ends = boundaries[1:] + [len(result.inputLines)]
+    for start, end, segment in zip(boundaries, ends, segments):
+        result.lines.extend(segment['lines'])
+        if segment['changed']:
+            result.changed = True
+        for trail in segment['parenTrails']:
+            result.parenTrails.append(dict(trail, lineNo=trail['lineNo'] + start))
+        # a segment may also see a cursor line that the selection overrides
+        if tabStopLine is not None and start <= tabStopLine < end:
+            for tabStop in segment['tabStops']:
+                result.tabStops.append(dict(tabStop, lineNo=tabStop['lineNo'] + start))
+        if segment['cursorLine'] is not None:
+            result.cursorX = segment['cursorX']
+            result.cursorLine = segment['cursorLine'] + start
+    result.success = True
+    return publicResult(result)
+
+def partitioned_mode(text, options=None, mode='paren', workers=None, executor=None,
+                     minLines=PARTITION_MIN_LINES):
+    """Same result as `mode` ('indent', 'paren' or 'smart'), computed by
+    processing top-level forms in parallel on `executor` (a new process pool
+    with `workers` processes if not given) when that is safe."""
+    import concurrent.futures
+
+    options = dict(options) if isinstance(options, dict) else {}
+    processMode, smart = getModeArgs(mode, options)
+    if not canPartition(options):
+        return MODE_FNS[mode](text, options)
+    lines, boundaries = partitionText(text, options, minLines)
+    if len(boundaries) == 1:
+        return MODE_FNS[mode](text, options)
+
+    ends = boundaries[1:] + [len(lines)]
+    ownExecutor = executor is None
+    if ownExecutor:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = [
+            executor.submit(processSegment,
+                            NEWLINE.join(lines[start:end]),
+                            segmentOptions(options, start, end),
+                            processMode, smart,
+                            sys.maxsize if k == 0 else 0)
+            for k, (start, end) in enumerate(zip(boundaries, ends))
+        ]
+        segments = [future.result() for future in futures]
+    finally:
+        if ownExecutor:
+            executor.shutdown()
+
+    if processMode == PAREN_MODE:
+        for k in range(1, len(segments)):
+            if segments[k-1] is None:
+                break
+            if segments[k-1]['maxIndent'] != 0:
+                # guessed the wrong maxIndent, so redo this segment with the right one
+                start, end = boundaries[k], ends[k]
+                segments[k] = processSegment(NEWLINE.join(lines[start:end]),
+                                             segmentOptions(options, start, end),
+                                             processMode, smart,
+                                             segments[k-1]['maxIndent'])
+
+    final = stitchSegments(text, options, processMode, smart, boundaries, segments)
+    if final is None:
+        return MODE_FNS[mode](text, options)
+    return final
+
+#-------------------------------------------------------------------------------
+# Viewport processing
+#-------------------------------------------------------------------------------
+
+# An editor showing a few lines of a huge buffer only needs those lines to be
+# correct.  `viewport_mode` widens the visible lines to the top-level forms
+# around them (as split by `partitioned_mode`) and processes only that window,
+# so its cost depends on the size of those forms rather than the buffer.
+# Unlike `partitioned_mode`, nothing above the window is processed to check
+# that its first line really starts a top-level form, so the result is
+# flagged as partial.
+
+# options whose line numbers we cannot translate to a window
+VIEWPORT_DROPPED_OPTIONS = ('returnParens', 'returnCheckpoints', 'checkpoints', 'editRange')
+
+def findFormStart(lines, lineNo):
+    while lineNo > 0 and lines[lineNo][:1] != '(':
+        lineNo -= 1
+    return lineNo
+
+def findFormEnd(lines, lineNo):
+    lineNo += 1
+    while lineNo < len(lines) and lines[lineNo][:1] != '(':
+        lineNo += 1
+    return lineNo - 1
+
+def shiftLineNos(final, delta):
+    if 'cursorLine' in final:
+        final['cursorLine'] += delta
+    for key in ('tabStops', 'parenTrails'):
+        for item in final.get(key) or []:
+            item['lineNo'] += delta
+    error = final.get('error')
+    if error:
+        if error.get('lineNo') is not None:
+            error['lineNo'] += delta
+        extra = error.get('extra')
+        if extra and extra.get('lineNo') is not None:
+            extra['lineNo'] += delta
+
+def viewport_mode(text, options=None, startLine=0, endLine=None, mode='smart'):
+    """Processes lines `startLine` through `endLine` (inclusive) of `text` and
+    the rest of the top-level forms they are part of, returning the result
+    for just those lines along with the `startLine` and `endLine` they span."""
+    options = dict(options) if isinstance(options, dict) else {}
+    for key in VIEWPORT_DROPPED_OPTIONS:
+        options.pop(key, None)
+    if mode not in MODE_FNS:
+        raise ValueError("unknown mode: " + str(mode))
+
+    lines = splitLines(text)
+    lastLine = len(lines) - 1
+    startLine = max(0, min(startLine, lastLine))
+    endLine = lastLine if endLine is None else max(startLine, min(endLine, lastLine))
+    start = findFormStart(lines, startLine)
+    end = findFormEnd(lines, endLine)
+
+    windowText = getLineEnding(text).join(lines[start:end+1])
+    final = MODE_FNS[mode](windowText, segmentOptions(options, start, end + 1))
+    shiftLineNos(final, start)
+    final['partial'] = True
+    final['startLine'] = start
+    final['endLine'] = end
+    return final
+
+#-------------------------------------------------------------------------------
+# Form cache
+#-------------------------------------------------------------------------------
+
+# An opt-in cache of processed top-level forms (see `enable_form_cache`), so
+# that editing one form of a large file only processes that form again.  The
+# text is split before every top-level form like in `partitioned_mode`, and
+# each segment is keyed by its text, the state it is entered with and its
+# (translated) options.  Segments are processed in order, so unlike
+# `partitioned_mode` they always know their real entering state.
+
+class FormCache(ResultCache):
+    """A thread-safe LRU cache of processed top-level forms."""
+    __slots__ = ()
+
+    copyEntries = False  # segments are never modified once processed
+
+    def process(self, text, options, mode, smart):
+        import json
+
+        segOptions = options if isinstance(options, dict) else {}
+        if not canPartition(segOptions):
+            return publicResult(processText(text, options, mode, smart))
+        lines, boundaries = partitionText(text, segOptions, 1)
+        ends = boundaries[1:] + [len(lines)]
+
+        segments = []
+        maxIndent = sys.maxsize
+        for start, end in zip(boundaries, ends):
+            segText = NEWLINE.join(lines[start:end])
+            segmentOpts = segmentOptions(segOptions, start, end)
+            try:
+                optionsKey = json.dumps(segmentOpts, sort_keys=True)
+            except (TypeError, ValueError):
+                return publicResult(processText(text, options, mode, smart))
+            key = (segText, mode, smart, maxIndent if mode == PAREN_MODE else None, optionsKey)
+            segment = self.get(key)
+            if segment is None:
+                segment = processSegment(segText, segmentOpts, mode, smart, maxIndent)
+                if segment is None:
+                    return publicResult(processText(text, options, mode, smart))
+                self.put(key, segText, segment)
+            segments.append(segment)
+            maxIndent = segment['maxIndent']
+
+        final = stitchSegments(text, segOptions, mode, smart, boundaries, segments)
+        if final is None:
+            return publicResult(processText(text, options, mode, smart))
+        return final
+
+formCache = None
+
+def enable_form_cache(maxEntries=4096, maxBytes=64*1024*1024):
+    """Puts a new FormCache in front of the mode functions and returns it."""
+    global formCache
+    formCache = FormCache(maxEntries, maxBytes)
+    return formCache
+
+def disable_form_cache():
+    global formCache
+    formCache = None
 
 API = {
     'version': '3.12.0',
@@ -1425,3 +3505,298 @@ API = {
     'paren_mode': paren_mode,
     'smart_mode': smart_mode
 }
+
+#-------------------------------------------------------------------------------
+# Language server
+#-------------------------------------------------------------------------------
+
+# `python3 -m parinfer --server` speaks JSON-RPC 2.0 over stdio with LSP-style
+# `Content-Length` framing, so that editors can keep one process (and its
+# documents) around instead of starting Python on every keystroke.
+#
+#   textDocument/didOpen    {textDocument: {uri, text}}
+#   textDocument/didChange  {textDocument: {uri}, contentChanges: [{range?, text}]}
+#   textDocument/didClose   {textDocument: {uri}}
+#   parinfer/indentMode     {textDocument: {uri}, options?} => result of indent_mode
+#   parinfer/parenMode      (same)
+#   parinfer/smartMode      (same)
+#
+# Positions in `range`s use the first position encoding in the client's
+# `general.positionEncodings` that we support, or LSP's default 'utf-16'.
+# Parinfer's own options and results are in characters, as always.
+# Incremental edits received since the last request are passed to it as the
+# `changes` option, and each document keeps a ParinferSession per mode so
+# that only the lines around the edits and the cursor are processed again.
+
+POSITION_ENCODINGS = ('utf-8', 'utf-16', 'utf-32')
+
+SERVER_MODES = {
+    'parinfer/indentMode': 'indent',
+    'parinfer/parenMode': 'paren',
+    'parinfer/smartMode': 'smart',
+}
+
+class ServerError(Exception):
+    def __init__(self, code, message):
+        super(ServerError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+class ServerDocument(object):
+    __slots__ = ('text', 'changes', 'sessions')
+    def __init__(self, text):
+        self.text = text          # [string] - current text of the document
+        self.changes = []         # [array of change objects] - edits since the last request (see `transformChange`)
+        self.sessions = {}        # [object] - maps mode name to its ParinferSession
+
+def getCodeUnits(ch, encoding):
+    if encoding == 'utf-8':
+        return len(ch.encode('utf-8', 'surrogatepass'))
+    return 2 if ord(ch) > 0xFFFF else 1
+
+def getOffset(text, line, character, encoding='utf-32'):
+    offset = 0
+    for _ in range(line):
+        offset = text.find(NEWLINE, offset)
+        if offset == -1:
+            return len(text)
+        offset += 1
+    end = text.find(NEWLINE, offset)
+    lineEnd = len(text) if end == -1 else end
+    if encoding == 'utf-32' or text[offset:lineEnd].isascii():
+        return min(offset + character, lineEnd)
+
+    # count code units up to `character`
+    units = 0
+    while offset < lineEnd:
+        units += getCodeUnits(text[offset], encoding)
+        if units > character:
+            break
+        offset += 1
+    return offset
+
+def getPositionEncoding(params):
+    capabilities = params.get('capabilities') or {}
+    general = capabilities.get('general') or {}
+    for encoding in general.get('positionEncodings') or []:
+        if encoding in POSITION_ENCODINGS:
+            return encoding
+    return 'utf-16'
+
+def applyContentChange(doc, change, encoding='utf-32'):
+    if 'range' not in change:
+        doc.text = change['text']
+        doc.changes = []
+        return
+
+    start = change['range']['start']
+    end = change['range']['end']
+    startOffset = getOffset(doc.text, start['line'], start['character'], encoding)
+    endOffset = getOffset(doc.text, end['line'], end['character'], encoding)
+    doc.changes.append({
+        'lineNo': start['line'],
+        'x': startOffset - doc.text.rfind(NEWLINE, 0, startOffset) - 1,
+        'oldText': doc.text[startOffset:endOffset],
+        'newText': change['text'],
+    })
+    doc.text = doc.text[:startOffset] + change['text'] + doc.text[endOffset:]
+
+class ParinferServer(object):
+    __slots__ = ('documents', 'running', 'positionEncoding')
+    def __init__(self):
+        self.documents = {}             # [object] - maps uri to ServerDocument
+        self.running = True
+        self.positionEncoding = 'utf-16'  # [string] - encoding of the `character` in positions
+
+    def getDocument(self, params):
+        uri = params['textDocument']['uri']
+        if uri not in self.documents:
+            raise ServerError(-32602, 'unknown document: ' + uri)
+        return self.documents[uri]
+
+    def call(self, method, params):
+        if method == 'initialize':
+            self.positionEncoding = getPositionEncoding(params)
+            return {
+                'capabilities': {
+                    'positionEncoding': self.positionEncoding,
+                    'textDocumentSync': {'openClose': True, 'change': 2},
+                },
+                'serverInfo': {'name': 'parinfer.py', 'version': API['version']},
+            }
+        if method == 'shutdown':
+            return None
+        if method == 'exit':
+            self.running = False
+            return None
+        if method == 'textDocument/didOpen':
+            doc = params['textDocument']
+            self.documents[doc['uri']] = ServerDocument(doc['text'])
+            return None
+        if method == 'textDocument/didChange':
+            doc = self.getDocument(params)
+            for change in params['contentChanges']:
+                applyContentChange(doc, change, self.positionEncoding)
+            return None
+        if method == 'textDocument/didClose':
+            self.documents.pop(params['textDocument']['uri'], None)
+            return None
+        if method in SERVER_MODES:
+            doc = self.getDocument(params)
+            mode = SERVER_MODES[method]
+            options = dict(params.get('options') or {})
+            options.pop('returnParens', None)  # the paren tree is not JSON
+            if doc.changes and 'changes' not in options:
+                options['changes'] = doc.changes
+            doc.changes = []
+            if mode not in doc.sessions:
+                doc.sessions[mode] = ParinferSession(mode)
+            return doc.sessions[mode].process(doc.text, options)
+        raise ServerError(-32601, 'method not found: ' + str(method))
+
+    def handle(self, message):
+        """Handles one decoded JSON-RPC message, returning the response (or None for notifications)."""
+        if not isinstance(message, dict):
+            # including batches, which we do not support
+            return {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32600, 'message': 'invalid request'}}
+        try:
+            final = {'result': self.call(message.get('method'), message.get('params') or {})}
+        except ServerError as e:
+            final = {'error': {'code': e.code, 'message': e.message}}
+        except (KeyError, TypeError, AttributeError) as e:
+            final = {'error': {'code': -32602, 'message': 'invalid params: ' + repr(e)}}
+        except Exception as e:
+            # keep serving the other documents
+            final = {'error': {'code': -32603, 'message': 'internal error: ' + repr(e)}}
+        if 'id' not in message:
+            return None
+        final['jsonrpc'] = '2.0'
+        final['id'] = message['id']
+        return final
+
+    def serve(self, inStream, outStream):
+        import json
+
+        while self.running:
+            length = None
+            while True:
+                header = inStream.readline()
+                if not header:
+                    return
+                header = header.strip()
+                if not header:
+                    break
+                name, _, value = header.partition(b':')
+                if name.strip().lower() == b'content-length':
+                    length = int(value)
+            if length is None:
+                continue
+
+            try:
+                message = json.loads(inStream.read(length).decode('utf-8'))
+            except ValueError:
+                final = {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32700, 'message': 'parse error'}}
+            else:
+                final = self.handle(message)
+            if final is not None:
+                body = json.dumps(final).encode('utf-8')
+                outStream.write(b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n' + body)
+                outStream.flush()
+
+#-------------------------------------------------------------------------------
+# Command line
+#-------------------------------------------------------------------------------
+
+# python3 -m parinfer [--mode paren] [--check] [--stats] [--workers N] PATH...
+# python3 -m parinfer --server
+
+DEFAULT_EXTENSIONS = '.clj,.cljs,.cljc,.cljx,.edn,.bb,.fnl,.lisp,.scm,.rkt,.el,.hy,.janet'
+
+def walkFiles(paths, extensions, onError):
+    """Yields (path, size) for each file given or found under a given directory,
+    calling `onError(path, exception)` for the ones that cannot be read."""
+    def sizedPath(path):
+        try:
+            return [(path, os.path.getsize(path))]
+        except OSError as e:
+            onError(path, e)
+            return []
+
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path, onerror=lambda e: onError(e.filename, e)):
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                for name in sorted(files):
+                    if os.path.splitext(name)[1] in extensions:
+                        yield from sizedPath(os.path.join(root, name))
+        else:
+            yield from sizedPath(path)
+
+def main(argv=None):
+    import argparse
+    import pathlib
+
+    parser = argparse.ArgumentParser(prog='python3 -m parinfer',
+                                     description='Run Parinfer over files and directories.')
+    parser.add_argument('paths', nargs='*', help='files or directories to process')
+    parser.add_argument('--mode', choices=sorted(MODE_FNS), default='paren')
+    parser.add_argument('--check', action='store_true',
+                        help='do not write files, exit non-zero if any would change or fail')
+    parser.add_argument('--stats', action='store_true', help='print files/sec and bytes/sec')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--extensions', default=DEFAULT_EXTENSIONS,
+                        help='comma-separated file extensions to look for in directories')
+    parser.add_argument('--server', action='store_true',
+                        help='run a JSON-RPC server over stdio instead of processing files')
+    args = parser.parse_args(argv)
+
+    if args.server:
+        ParinferServer().serve(sys.stdin.buffer, sys.stdout.buffer)
+        return 0
+    if not args.paths:
+        parser.error('no paths given')
+
+    extensions = frozenset(args.extensions.split(','))
+    files = []
+    numErrors = 0
+    def onError(path, e):
+        nonlocal numErrors
+        numErrors += 1
+        print('error: {}: {}'.format(path, e), file=sys.stderr, flush=True)
+    def items():
+        for path, size in walkFiles(args.paths, extensions, onError):
+            files.append((path, size))
+            yield pathlib.Path(path)
+
+    startTime = time.perf_counter()
+    numFiles = numBytes = numChanged = 0
+    # smart_mode(text, None) runs Indent Mode, so pass options to get Smart Mode
+    for i, final in batch(items(), args.mode, {}, workers=args.workers,
+                          ordered=False, write=not args.check):
+        path, size = files[i]
+        numFiles += 1
+        numBytes += size
+        if not final['success']:
+            e = final['error']
+            if 'exception' in e:
+                onError(path, e['exception'])
+            else:
+                onError('{}:{}:{}'.format(path, e['lineNo'] + 1, e['x'] + 1), e['message'])
+        elif final['changed']:
+            numChanged += 1
+            print(('would reformat ' if args.check else 'reformatted ') + path, flush=True)
+    elapsed = time.perf_counter() - startTime
+
+    if args.stats:
+        print('{} files ({} bytes) in {:.3f} s: {:.1f} files/s, {:.1f} bytes/s; {} {}, {} failed'.format(
+            numFiles, numBytes, elapsed,
+            numFiles / elapsed if elapsed else 0,
+            numBytes / elapsed if elapsed else 0,
+            numChanged, 'would change' if args.check else 'changed', numErrors), file=sys.stderr)
+
+    if numErrors or (args.check and numChanged):
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
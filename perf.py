@@ -1,7 +1,12 @@
 import cProfile
+import gc
+import json
 import os
+import subprocess
+import sys
 import time
 
+import parinfer
 from parinfer import indent_mode, paren_mode, smart_mode
 
 def timeProcess(name, string, options):
@@ -29,11 +34,253 @@ def timeProcess(name, string, options):
     # cProfile.runctx("indent_mode(string, options)", globals(), locals())
     # cProfile.runctx("paren_mode(string, options)", globals(), locals())
 
+def bestOf(n, fn, *args):
+    best = None
+    for i in range(n):
+        t = time.perf_counter()
+        fn(*args)
+        dt = (time.perf_counter() - t) * 1000
+        best = dt if best is None else min(best, dt)
+    return best
+
+def timeFastPaths(name, string, options):
+    print("Fast paths", name, ":")
+    for modeName, fn in (("indent", indent_mode), ("paren", paren_mode), ("smart", smart_mode)):
+        parinfer.USE_FAST_PATHS = False
+        slow = bestOf(3, fn, string, options)
+        parinfer.USE_FAST_PATHS = True
+        fast = bestOf(3, fn, string, options)
+        print(modeName + ":", '{:.3f}'.format(slow), "ms ->", '{:.3f}'.format(fast), "ms",
+              '({:.2f}x)'.format(slow / fast))
+    print()
+
+# Minified EDN puts a whole document on one line.  The line is generated here
+# rather than stored in tests/perf to keep the repo (and this script) small.
+LONG_LINE_ITEM = '{:id 42\t:name "parinfer"\t:tags [:a :b :c]\t:nested {:x (1 2 3)}}\t'
+
+def timeLongLine(sizes):
+    print("Single long line scaling:")
+    for size in sizes:
+        string = '[' + LONG_LINE_ITEM * (size // len(LONG_LINE_ITEM)) + ']'
+        megabytes = len(string) / 1e6
+        for modeName, fn in (("indent", indent_mode), ("paren", paren_mode)):
+            dt = bestOf(1, fn, string, {})
+            print(modeName + ":", '{:.2f}'.format(megabytes), "MB",
+                  '{:.3f}'.format(dt), "ms", '({:.1f} ms/MB)'.format(dt / megabytes))
+    print()
+
+def timeBatch(texts, workerCounts):
+    numchars = sum(len(text) for text in texts)
+    print("Batch of", len(texts), "texts,", numchars, "chars:")
+    cpus = os.cpu_count() or 1
+    if cpus == 1:
+        print("only 1 CPU: workers cannot run in parallel here, so no speedup is measured")
+    for workers in workerCounts:
+        t = time.perf_counter()
+        for result in parinfer.batch(texts, 'paren', workers=workers):
+            pass
+        dt = time.perf_counter() - t
+        print("workers", workers, ":", '{:.3f}'.format(dt * 1000), "ms",
+              '({:.1f} texts/s)'.format(len(texts) / dt))
+    print()
+
+def timeLineCache(name, string, options):
+    print("Line cache", name, ":")
+    for modeName, fn in (("indent", indent_mode), ("paren", paren_mode), ("smart", smart_mode)):
+        parinfer.disable_line_cache()
+        uncached = bestOf(3, fn, string, options)
+        # a new cache for every run, so only lines repeated within the text hit
+        cached = bestOf(3, lambda: (parinfer.enable_line_cache(), fn(string, options)))
+        stats = parinfer.lineCache.stats()
+        parinfer.disable_line_cache()
+        lookups = stats['hits'] + stats['misses']
+        print(modeName + ":", '{:.3f}'.format(uncached), "ms ->", '{:.3f}'.format(cached), "ms",
+              '({:.2f}x,'.format(uncached / cached),
+              'hit rate {:.0f}%)'.format(100 * stats['hits'] / lookups if lookups else 0))
+    print()
+
+def timeSmartFallback(name, string):
+    print("Smart Mode fallback", name, ":")
+    # type a close-paren at the start of an indented line near the end, which
+    # makes Smart Mode fall back to Paren Mode
+    # an editor only sends text that Smart Mode has already processed
+    string = smart_mode(string, {})['text']
+    lines = string.split('\n')
+    lineNo = len(lines) * 9 // 10
+    while lineNo < len(lines) and not lines[lineNo].startswith(' '):
+        lineNo += 1
+    if lineNo == len(lines):
+        return
+    options = {'cursorLine': lineNo, 'cursorX': 1}
+    edited = lines[:]
+    edited[lineNo] = ')' + edited[lineNo].lstrip()
+    edited = '\n'.join(edited)
+
+    noFallback = bestOf(3, smart_mode, string, options)
+    fallback = bestOf(3, smart_mode, edited, options)
+    print("smart:", '{:.3f}'.format(noFallback), "ms ->", '{:.3f}'.format(fallback), "ms with fallback,",
+          "resumed at line", smart_mode(edited, options)['fallbackLineNo'])
+    print()
+
+def timeUnclosedQuote(name, string):
+    print("Unclosed quote near the top of", name, "(other strings removed):")
+    lines = string.replace('"', '').split('\n')
+    lines[10] += ' "'
+    string = '\n'.join(lines)
+    canStop = parinfer.canStopAtUnclosedQuote
+    for modeName, fn in (("indent", indent_mode), ("paren", paren_mode)):
+        parinfer.canStopAtUnclosedQuote = lambda result: False
+        slow = bestOf(3, fn, string, {})
+        parinfer.canStopAtUnclosedQuote = canStop
+        fast = bestOf(3, fn, string, {})
+        print(modeName + ":", '{:.3f}'.format(slow), "ms ->", '{:.3f}'.format(fast), "ms",
+              '({:.1f}x)'.format(slow / fast))
+    print()
+
+def timeSkipRuns(name, string):
+    print("Skipping runs inside strings and comments", name, ":")
+    isSkippable = parinfer.isSkippableRun
+    for modeName, fn in (("indent", indent_mode), ("paren", paren_mode), ("smart", smart_mode)):
+        parinfer.isSkippableRun = lambda result: False
+        slow = bestOf(3, fn, string, {})
+        parinfer.isSkippableRun = isSkippable
+        fast = bestOf(3, fn, string, {})
+        print(modeName + ":", '{:.3f}'.format(slow), "ms ->", '{:.3f}'.format(fast), "ms",
+              '({:.1f}x)'.format(slow / fast))
+    print()
+
+def measureGarbage(name, string):
+    # short-lived objects are freed by reference counting as soon as they are
+    # dropped; what churn costs beyond that is the cyclic collector, which runs
+    # every few hundred container allocations and walks the young objects
+    print("Garbage collection", name, ":")
+    numlines = len(string.splitlines())
+    collections = [0]
+    gcTime = [0.0, 0.0]
+    def onCollect(phase, info):
+        if phase == 'start':
+            collections[0] += 1
+            gcTime[1] = time.perf_counter()
+        else:
+            gcTime[0] += time.perf_counter() - gcTime[1]
+    for options in ({}, {'returnParens': True}):
+        for modeName, fn in (("indent", indent_mode), ("paren", paren_mode), ("smart", smart_mode)):
+            gc.collect()
+            collections[0], gcTime[0] = 0, 0.0
+            gc.callbacks.append(onCollect)
+            t = time.perf_counter()
+            fn(string, dict(options))
+            dt = time.perf_counter() - t
+            gc.callbacks.remove(onCollect)
+            print(modeName + ":", collections[0], "collections,",
+                  '{:.3f}'.format(gcTime[0] * 1000), "ms in gc,",
+                  '{:.2f}'.format(gcTime[0] * 1e6 / numlines), "us per line,",
+                  '{:.1f}%'.format(gcTime[0] * 100 / dt), "of",
+                  '{:.1f}'.format(dt * 1000), "ms",
+                  "with returnParens" if options else "")
+    print()
+
+class ServerClient(object):
+    """Drives `python3 -m parinfer --server` over stdio."""
+    def __init__(self):
+        self.process = subprocess.Popen([sys.executable, '-m', 'parinfer', '--server'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.nextId = 0
+
+    def send(self, method, params, notify=False):
+        message = {'jsonrpc': '2.0', 'method': method, 'params': params}
+        if not notify:
+            self.nextId += 1
+            message['id'] = self.nextId
+        body = json.dumps(message).encode('utf-8')
+        self.process.stdin.write(b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n' + body)
+        self.process.stdin.flush()
+        if notify:
+            return None
+        length = None
+        while True:
+            header = self.process.stdout.readline().strip()
+            if not header:
+                break
+            if header.lower().startswith(b'content-length:'):
+                length = int(header.split(b':')[1])
+        return json.loads(self.process.stdout.read(length))
+
+    def close(self):
+        self.send('shutdown', None)
+        self.send('exit', None, notify=True)
+        self.process.wait()
+
+def timeServer(name, string, numEdits):
+    print("Server latency", name, ":")
+    client = ServerClient()
+    client.send('initialize', {})
+    uri = 'file:///' + name
+    client.send('textDocument/didOpen', {'textDocument': {'uri': uri, 'text': string}}, notify=True)
+
+    lineNo = len(string.splitlines()) // 2
+    latencies = []
+    for i in range(numEdits):
+        # alternately type and delete a space at the start of a line
+        typing = i % 2 == 0
+        t = time.perf_counter()
+        client.send('textDocument/didChange', {
+            'textDocument': {'uri': uri},
+            'contentChanges': [{
+                'range': {'start': {'line': lineNo, 'character': 0},
+                          'end': {'line': lineNo, 'character': 0 if typing else 1}},
+                'text': ' ' if typing else '',
+            }]
+        }, notify=True)
+        client.send('parinfer/smartMode', {
+            'textDocument': {'uri': uri},
+            'options': {'cursorLine': lineNo, 'cursorX': 1 if typing else 0}
+        })
+        latencies.append((time.perf_counter() - t) * 1000)
+    client.close()
+
+    latencies.sort()
+    print("median:", '{:.3f}'.format(latencies[len(latencies) // 2]), "ms",
+          "p95:", '{:.3f}'.format(latencies[int(len(latencies) * 0.95)]), "ms",
+          "max:", '{:.3f}'.format(latencies[-1]), "ms")
+    print()
+
+# the other benchmarks take a while, so they only run with --all
+runAll = '--all' in sys.argv[1:]
+
 perfDir = 'tests/perf'
 for file in os.listdir(perfDir):
     with open(os.path.join(perfDir, file), 'r') as f:
         text = f.read()
     if text:
         timeProcess(file, text, {})
+        if runAll:
+            timeFastPaths(file, text, {})
+            timeLineCache(file, text, {})
     else:
         print("error: could not open:",file)
+
+if runAll:
+    timeLongLine([100000, 200000, 400000, 800000])
+
+    with open(os.path.join(perfDir, 'really_long_file'), 'r') as f:
+        text = f.read()
+        timeSmartFallback('really_long_file', text)
+        timeUnclosedQuote('really_long_file', text)
+        measureGarbage('really_long_file', text)
+
+    # strings in long_map_with_strings are a few characters long, so most of
+    # the gain is in docstrings and comments
+    for file in ('long_map_with_strings', 'docstrings_and_comments'):
+        with open(os.path.join(perfDir, file), 'r') as f:
+            timeSkipRuns(file, f.read())
+
+    perfTexts = []
+    for file in os.listdir(perfDir):
+        with open(os.path.join(perfDir, file), 'r') as f:
+            perfTexts.append(f.read())
+    cpus = os.cpu_count() or 1
+    timeBatch(perfTexts * 2, sorted(set([w for w in (1, 2, 4, cpus) if w <= cpus])))
+
+    with open(os.path.join(perfDir, 'really_long_file'), 'r') as f:
+        timeServer('really_long_file', f.read(), 20)
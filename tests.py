@@ -2,9 +2,25 @@
 ## NOTE: this file is pretty quick and dirty
 ##       it could use some work to be more robust
 
+import asyncio
+import contextlib
+import io
 import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
 import unittest
-from parinfer import indent_mode, paren_mode, smart_mode
+import parinfer
+from parinfer import indent_mode, paren_mode, smart_mode, ParinferSession
+from parinfer import iter_indent_mode, iter_paren_mode, process_bytes, process_file
+from parinfer import INDENT_MODE, PAREN_MODE, batch, main
+from parinfer import indent_mode_async, paren_mode_async, smart_mode_async
+from parinfer import ParinferServer, enable_result_cache, disable_result_cache
+from parinfer import partitioned_mode, enable_form_cache, disable_form_cache
+from parinfer import enable_line_cache, disable_line_cache, viewport_mode
+from parinfer import is_stable
 
 # load test files
 with open('./tests/cases/indent-mode.json') as indent_mode_tests_json:
@@ -132,10 +148,10 @@ class TestParinfer(unittest.TestCase):
         self.check_error('paren', '(foo \\', "eol-backslash", 0, 5)
         self.check_error('paren', '(foo]\nbar)', "unmatched-close-paren", 0, 4)
 
-    # def check_changed_lines(self, mode, text, changed_lines):
-    #     result = modeFn[mode](text, None)
-    #     # print(result)
-    #     self.assertEqual(result['changedLines'], changed_lines)
+    def check_changed_lines(self, mode, text, changed_lines):
+        result = modeFn[mode](text, {'returnEdits': True})
+        self.assertEqual(result['changedLines'], changed_lines)
+        self.assertNotIn('text', result)
 
     def check_result(self, mode, text, expected_text):
         result = modeFn[mode](text, None)
@@ -147,5 +163,537 @@ class TestParinfer(unittest.TestCase):
         self.check_result('paren', "(foo\nbar)", "(foo\n bar)")
         # self.check_result('paren', "(foo]\nbar)", "(foo\n bar)")
 
+    def test_edits(self):
+        self.check_changed_lines('indent', "(foo\nbar", [0])
+        self.check_changed_lines('paren', "(foo\nbar)", [1])
+        self.check_changed_lines('paren', "(foo\n bar)", [])
+
+        result = paren_mode("(let [a 1\n b 2]\n  c )", {'returnEdits': True, 'returnText': True})
+        self.assertEqual(result['text'], "(let [a 1\n      b 2]\n  c)")
+        self.assertEqual(result['edits'], [
+            {'lineNo': 1, 'startX': 1, 'endX': 1, 'replacement': '     '},
+            {'lineNo': 2, 'startX': 3, 'endX': 4, 'replacement': ''},
+        ])
+
+    def test_tabs(self):
+        # a tab in code becomes two spaces, and a leading close-paren after it
+        # still moves to the paren trail of the line above
+        for useFastPaths in (True, False):
+            parinfer.USE_FAST_PATHS = useFastPaths
+            try:
+                result = paren_mode('{\n\t}', None)
+                self.assertEqual(result['text'], '{}\n  ')
+                self.assertEqual(result['parenTrails'], [{'lineNo': 0, 'startX': 1, 'endX': 2}])
+
+                result = paren_mode('\t\t\n{\n\t}', {'cursorLine': 0, 'cursorX': 1})
+                self.assertEqual(result['text'], '    \n{}\n  ')
+                self.assertEqual(result['parenTrails'], [{'lineNo': 1, 'startX': 1, 'endX': 2}])
+
+                # the cursor may clamp the paren trail past the end of the line
+                result = indent_mode('b\n) a\n)', {'cursorLine': 0, 'cursorX': 4})
+                self.assertEqual(result['error']['name'], 'leading-close-paren')
+            finally:
+                parinfer.USE_FAST_PATHS = True
+
+    def test_unchanged(self):
+        text = '(foo\r\n bar)\r\n(baz)'
+        for mode in ('indent', 'paren', 'smart'):
+            result = modeFn[mode](text, None)
+            self.assertIs(result['text'], text)
+            self.assertFalse(result['changed'])
+
+        result = paren_mode('(foo\nbar)', None)
+        self.assertEqual(result['text'], '(foo\n bar)')
+        self.assertTrue(result['changed'])
+        # line endings are still normalized
+        result = paren_mode('(foo\r\n bar)\n', None)
+        self.assertEqual(result['text'], '(foo\r\n bar)\r\n')
+        self.assertTrue(result['changed'])
+
+    def test_is_stable(self):
+        text = '(foo\n bar)\n(baz)'
+        for mode in ('indent', 'paren', 'smart'):
+            self.assertEqual(is_stable(text, mode), {'stable': True})
+
+        self.assertEqual(is_stable('(foo\nbar)', 'paren'),
+                         {'stable': False, 'lineNo': 1, 'x': 0})
+        self.assertEqual(is_stable('(foo\n  bar))', 'indent'),
+                         {'stable': False, 'lineNo': 1, 'x': 6})
+        self.assertEqual(is_stable('(foo\r\n bar)\n(baz)', 'paren'),
+                         {'stable': False, 'lineNo': 1, 'x': 5})
+
+        result = is_stable('(foo "bar)', 'paren')
+        self.assertFalse(result['stable'])
+        self.assertEqual(result['error']['name'], 'unclosed-quote')
+        self.assertEqual((result['lineNo'], result['x']), (0, 5))
+
+    def test_unclosed_quote(self):
+        lines = ['(foo) ; "not" a string', '(bar \\" "baz'] + ['(qux a b)'] * 100
+        for mode in ('indent', 'paren', 'smart'):
+            result = modeFn[mode]('\n'.join(lines), None)
+            self.assertFalse(result['success'])
+            self.assertEqual(result['error'], {
+                'name': 'unclosed-quote',
+                'message': 'String is missing a closing quote.',
+                'lineNo': 1, 'x': 8})
+
+        # a multi-line string that is closed does not stop processing
+        result = paren_mode('(def a "multi\nline \\"\n")\n(bar "baz\n(qux)', None)
+        self.assertEqual((result['error']['name'], result['error']['lineNo'], result['error']['x']),
+                         ('unclosed-quote', 3, 5))
+
+        # errors before the string are still found
+        result = paren_mode('(foo))\n(bar "baz', None)
+        self.assertEqual(result['error']['name'], 'unmatched-close-paren')
+        result = paren_mode('(foo \\\n(bar "baz', None)
+        self.assertEqual(result['error']['name'], 'eol-backslash')
+
+    def test_smart_fallback(self):
+        options = {'cursorLine': 5, 'cursorX': 3}
+        result = smart_mode('(def a 1)\n\n(def b\n  2)\n(let [a 1\n  ] a)', options)
+        self.assertEqual(result['text'], '(def a 1)\n\n(def b\n  2)\n(let [a 1]\n   a)')
+        # Paren Mode resumed from the last top-level form
+        self.assertEqual(result['fallbackLineNo'], 4)
+
+        # Paren Mode would dedent line 1, so it has to start over
+        result = smart_mode('(def a 1)\n  (def b\n  2)\n\n(let [a 1\n  ] a)', dict(options, cursorLine=5))
+        self.assertEqual(result['text'], '(def a 1)\n(def b\n 2)\n\n(let [a 1]\n   a)')
+        self.assertEqual(result['fallbackLineNo'], 0)
+
+        result = smart_mode('(def a 1)\n\n(let [a 1]\n  a)', options)
+        self.assertNotIn('fallbackLineNo', result)
+
+    def test_comment_line_parent(self):
+        # comment lines follow the shifted opener they belong to, but not
+        # openers from a previous top-level form
+        text = '(foo\n(bar\n  ;; c\n baz))\n(foo\n  ;; c\n bar)'
+        result = paren_mode(text, None)
+        self.assertEqual(result['text'], '(foo\n (bar\n   ;; c\n  baz))\n(foo\n  ;; c\n bar)')
+
+        text = '\n'.join([' ' * i + '{:a' for i in range(100)] + [';; c', ' ' * 100 + ':b' + '}' * 100])
+        for fn in (indent_mode, paren_mode, smart_mode):
+            self.assertEqual(fn(text, None)['text'], text)
+
+    def test_deadline(self):
+        text = '(foo\n  bar)\n(baz\nqux)\n(a b)'
+        expected = paren_mode(text, None)
+        self.assertEqual(paren_mode(text, {'budget': 60000}), expected)
+
+        # a deadline that has passed still processes one line per call
+        result = paren_mode(text, {'deadline': 0})
+        self.assertTrue(result['partial'])
+        self.assertEqual((result['stopLine'], result['endLine'], result['text']), (1, -1, ''))
+        stopLines = []
+        while result.get('partial'):
+            stopLines.append(result['stopLine'])
+            self.assertEqual(result['text'].split('\n')[:result['endLine']+1],
+                             expected['text'].split('\n')[:result['endLine']+1])
+            result = paren_mode(text, {'deadline': 0, 'continuation': result['continuation']})
+        self.assertEqual(stopLines, [1, 2, 3, 4])
+        self.assertEqual(result, expected)
+
+        # Smart Mode may still fall back to Paren Mode, so no line is final
+        result = smart_mode(text, {'deadline': 0})
+        self.assertEqual((result['stopLine'], result['endLine']), (1, -1))
+
+        # continuing a Smart Mode run that fell back to Paren Mode gives the
+        # same result, resuming from the same line
+        text = '(def a 1)\n\n(def b\n  2)\n(let [a 1\n  ] a)'
+        options = {'cursorLine': 5, 'cursorX': 3}
+        expected = smart_mode(text, options)
+        self.assertEqual(expected['fallbackLineNo'], 4)
+        result = smart_mode(text, dict(options, deadline=0))
+        while result.get('partial'):
+            result = smart_mode(text, dict(options, deadline=0, continuation=result['continuation']))
+        self.assertEqual(result, expected)
+
+        # a continuation for another text is ignored
+        continuation = paren_mode(text, {'deadline': 0})['continuation']
+        self.assertEqual(paren_mode('(a\nb)', {'continuation': continuation}), paren_mode('(a\nb)', None))
+
+    def test_checkpoints(self):
+        with open('./tests/perf/really_long_file') as f:
+            text = f.read()
+        lines = text.split('\n')
+        for mode in ('indent', 'paren', 'smart'):
+            prev = modeFn[mode](text, {'returnCheckpoints': True})
+
+            # edit a line near the end
+            edited = lines[:]
+            edited[2800] = edited[2800] + ' (foo'
+            editedText = '\n'.join(edited)
+            result = modeFn[mode](editedText, {
+                'checkpoints': prev['checkpoints'],
+                'editRange': {'lineNo': 2800, 'oldEndLineNo': 2800, 'newEndLineNo': 2800}
+            })
+            del result['checkpoints']
+            self.assertEqual(result, modeFn[mode](editedText, {}))
+
+            # insert a line near the top
+            edited = lines[:]
+            edited.insert(40, '  (bar baz)')
+            editedText = '\n'.join(edited)
+            result = modeFn[mode](editedText, {
+                'checkpoints': prev['checkpoints'],
+                'editRange': {'lineNo': 40, 'oldEndLineNo': 40, 'newEndLineNo': 41},
+                'cursorLine': 40,
+                'cursorX': 11,
+            })
+            del result['checkpoints']
+            self.assertEqual(result, modeFn[mode](editedText, {'cursorLine': 40, 'cursorX': 11}))
+
+    def test_session(self):
+        with open('./tests/perf/long_map_with_strings') as f:
+            text = f.read()
+        for mode in ('indent', 'paren', 'smart'):
+            session = ParinferSession(mode)
+            for cursorLine in (10, 10, 150, 151, 3):
+                options = {'cursorLine': cursorLine, 'cursorX': 4}
+                self.assertEqual(session.process(text, options), modeFn[mode](text, options))
+
+            edited = text.replace('"', '', 1)
+            options = {'cursorLine': 3, 'cursorX': 1}
+            self.assertEqual(session.process(edited, options), modeFn[mode](edited, options))
+
+    def test_session_result_copies(self):
+        with open('./tests/perf/long_map_with_strings') as f:
+            text = f.read()
+        options = {'cursorLine': 10, 'cursorX': 4}
+        session = ParinferSession('indent')
+        result = session.process(text, options)
+        for trail in result['parenTrails']:
+            trail['lineNo'] += 1
+        result['tabStops'].clear()
+
+        again = session.process(text, options)
+        self.assertIsNot(again['parenTrails'], result['parenTrails'])
+        self.assertEqual(again, indent_mode(text, options))
+
+        edited = text.replace('"', '', 1)
+        self.assertEqual(session.process(edited, options), indent_mode(edited, options))
+
+    def test_streaming(self):
+        with open('./tests/perf/really_long_file') as f:
+            text = f.read()
+        for streamFn, fn in ((iter_indent_mode, indent_mode), (iter_paren_mode, paren_mode)):
+            for t in (text, text + '\n', '(foo\n  bar\n', ''):
+                with self.subTest(streamFn.__name__ + ' ' + repr(t[:10])):
+                    expected = fn(t, None)
+                    stream = streamFn(io.StringIO(t))
+                    out = io.StringIO()
+                    self.assertEqual(stream.write(out), expected['success'])
+                    if expected['success']:
+                        self.assertEqual(out.getvalue(), expected['text'])
+
+        stream = iter_paren_mode(['(foo', '  bar'])
+        list(stream)
+        self.assertEqual(stream.success, False)
+        self.assertEqual(stream.error, paren_mode('(foo\n  bar', None)['error'])
+
+    def test_bytes(self):
+        text = '(défn foo\n  "ü")\n(bar\n baz]'
+        data = text.encode('utf-8')
+        expected = paren_mode(text, None)
+        self.assertEqual(process_bytes(data, PAREN_MODE)['error'], expected['error'])
+
+        text = '(défn foo\n"ü")\n'
+        data = text.encode('utf-8')
+        for buf in (data, bytearray(data), memoryview(data)):
+            result = process_bytes(buf, PAREN_MODE)
+            self.assertEqual(result['changed'], True)
+            self.assertEqual(result['text'], paren_mode(text, None)['text'].encode('utf-8'))
+
+        stable = indent_mode(text, None)['text'].encode('utf-8')
+        result = process_bytes(stable, INDENT_MODE)
+        self.assertEqual(result['changed'], False)
+        self.assertIs(result['text'], stable)
+
+        # a changed file is replaced by a new copy, unless it is patched in place
+        for inPlace in (False, True):
+            with tempfile.NamedTemporaryFile(delete=False) as f:
+                f.write(data)
+            try:
+                inode = os.stat(f.name).st_ino
+                self.assertEqual(process_file(f.name, PAREN_MODE, inPlace=inPlace)['changed'], True)
+                with open(f.name, 'rb') as f2:
+                    self.assertEqual(f2.read(), paren_mode(text, None)['text'].encode('utf-8'))
+                self.assertEqual(os.stat(f.name).st_ino == inode, inPlace)
+                self.assertEqual(process_file(f.name, PAREN_MODE, inPlace=inPlace)['changed'], False)
+            finally:
+                os.unlink(f.name)
+
+    def test_batch(self):
+        texts = [case['text'] for case in PAREN_MODE_TESTS]
+        for mode in ('indent', 'paren', 'smart'):
+            expected = [modeFn[mode](text, None) for text in texts]
+            self.assertEqual(list(batch(texts, mode, workers=2)), expected)
+            unordered = sorted(batch(texts, mode, workers=2, ordered=False), key=lambda pair: pair[0])
+            self.assertEqual([final for i, final in unordered], expected)
+
+    def test_batch_files(self):
+        with tempfile.TemporaryDirectory() as d:
+            paths = [pathlib.Path(d, name) for name in ('a.clj', 'b.clj', 'c.clj')]
+            paths[0].write_text('(foo\nbar)')
+            paths[1].write_bytes('(caf\xe9\n bar)'.encode('latin-1'))
+            paths[2].write_text('(foo\r\n  bar)')
+            options = {'cursorLine': 1, 'cursorX': 0}
+            for mode in ('indent', 'paren', 'smart'):
+                finals = list(batch(paths, mode, options, workers=1))
+                error = finals[1]['error']
+                self.assertEqual((finals[1]['success'], error['name'], error['path']),
+                                 (False, 'exception', str(paths[1])))
+                self.assertIsInstance(error['exception'], UnicodeDecodeError)
+                # the other files are still processed, like their texts would be
+                for path, final in zip(paths[::2], finals[::2]):
+                    text = path.read_bytes().decode('utf-8')
+                    expected = modeFn[mode](text, options)
+                    self.assertEqual((final['success'], final['changed'], final['cursorX']),
+                                     (True, expected['text'] != text, expected['cursorX']))
+
+            self.assertEqual(process_bytes(b'(foo\r\nbar)', INDENT_MODE, options, True)['text'],
+                             smart_mode('(foo\r\nbar)', options)['text'].encode('utf-8'))
+
+    def test_command_line(self):
+        def run(args):
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                code = main(args)
+            return code, stdout.getvalue().splitlines()
+
+        with tempfile.TemporaryDirectory() as d:
+            a = os.path.join(d, 'a.clj')
+            with open(a, 'w') as f:
+                f.write('(foo\nbar)')
+            with open(os.path.join(d, 'b.clj'), 'w') as f:
+                f.write('(foo\n bar)')
+            with open(os.path.join(d, 'c.txt'), 'w') as f:
+                f.write('(foo')
+
+            self.assertEqual(run(['--check', d]), (1, ['would reformat ' + a]))
+            self.assertEqual(run([d]), (0, ['reformatted ' + a]))
+            with open(a) as f:
+                self.assertEqual(f.read(), '(foo\n bar)')
+            self.assertEqual(run(['--check', d]), (0, []))
+
+            # --mode smart runs Smart Mode, not Indent Mode
+            with open(a, 'w') as f:
+                f.write('(let [a 1\n  ] a)')
+            self.assertEqual(run(['--mode', 'smart', a]), (0, ['reformatted ' + a]))
+            with open(a) as f:
+                self.assertEqual(f.read(), '(let [a 1]\n   a)')
+
+            # bad inputs are reported, and the other files are still processed
+            with open(os.path.join(d, 'd.clj'), 'wb') as f:
+                f.write('(caf\xe9\nbar)'.encode('latin-1'))
+            e = os.path.join(d, 'e.clj')
+            with open(e, 'w') as f:
+                f.write('(foo\nbar)')
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                self.assertEqual(run([d, os.path.join(d, 'missing.clj')]), (1, ['reformatted ' + e]))
+            self.assertIn('d.clj', stderr.getvalue())
+            self.assertIn('missing.clj', stderr.getvalue())
+            with open(e) as f:
+                self.assertEqual(f.read(), '(foo\n bar)')
+            self.assertEqual(sorted(os.listdir(d)), ['a.clj', 'b.clj', 'c.txt', 'd.clj', 'e.clj'])
+
+    def test_lazy_imports(self):
+        # editor plugins import parinfer at startup, so the optional APIs
+        # import their dependencies only when they are used
+        code = ('import sys, parinfer; '
+                'print(sorted({"asyncio", "concurrent.futures", "json", "hashlib", "mmap", "copy"} & set(sys.modules)))')
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.strip(), '[]')
+
+    def test_async(self):
+        text = '(foo\nbar)'
+        async def run():
+            self.assertEqual(await indent_mode_async(text), indent_mode(text, None))
+            self.assertEqual(await paren_mode_async(text), paren_mode(text, None))
+
+            # only the latest call for a buffer completes
+            calls = [smart_mode_async(text + '\n' * i, None, bufferId='buf') for i in range(5)]
+            results = await asyncio.gather(*calls, return_exceptions=True)
+            for final in results[:-1]:
+                self.assertIsInstance(final, asyncio.CancelledError)
+            self.assertEqual(results[-1], smart_mode(text + '\n' * 4, None))
+        asyncio.run(run())
+
+    def test_server(self):
+        server = ParinferServer()
+        uri = 'file:///foo.clj'
+        text = '(defn foo\n  [a b]\n  (+ a b))'
+        self.assertEqual(server.handle({'method': 'textDocument/didOpen',
+                                        'params': {'textDocument': {'uri': uri, 'text': text}}}), None)
+
+        # indent the first line by 2 spaces
+        server.handle({'method': 'textDocument/didChange', 'params': {
+            'textDocument': {'uri': uri},
+            'contentChanges': [{'range': {'start': {'line': 0, 'character': 0},
+                                          'end': {'line': 0, 'character': 0}},
+                                'text': '  '}]
+        }})
+        response = server.handle({'id': 1, 'method': 'parinfer/smartMode', 'params': {
+            'textDocument': {'uri': uri},
+            'options': {'cursorLine': 0, 'cursorX': 2}
+        }})
+        expected = smart_mode('  ' + text, {
+            'cursorLine': 0,
+            'cursorX': 2,
+            'changes': [{'lineNo': 0, 'x': 0, 'oldText': '', 'newText': '  '}]
+        })
+        self.assertEqual(response['result'], expected)
+        self.assertEqual(response['id'], 1)
+
+        response = server.handle({'id': 2, 'method': 'parinfer/parenMode',
+                                  'params': {'textDocument': {'uri': 'file:///missing.clj'}}})
+        self.assertEqual(response['error']['code'], -32602)
+
+        # framing over stdio
+        body = json.dumps({'jsonrpc': '2.0', 'id': 3, 'method': 'parinfer/indentMode',
+                           'params': {'textDocument': {'uri': uri}}}).encode('utf-8')
+        out = io.BytesIO()
+        server.serve(io.BytesIO(b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n' + body), out)
+        header, _, body = out.getvalue().partition(b'\r\n\r\n')
+        self.assertEqual(json.loads(body)['result'], indent_mode('  ' + text, None))
+
+    def test_server_errors(self):
+        def frame(message):
+            body = json.dumps(message).encode('utf-8')
+            return b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n' + body
+
+        # a batch is an invalid request, and the server keeps going after it
+        server = ParinferServer()
+        out = io.BytesIO()
+        server.serve(io.BytesIO(frame([1, 2]) + frame({'id': 1, 'method': 'shutdown'})), out)
+        responses = [json.loads(body.split(b'Content-Length')[0])
+                     for body in out.getvalue().split(b'\r\n\r\n')[1:]]
+        self.assertEqual(responses[0]['error']['code'], -32600)
+        self.assertEqual(responses[1], {'jsonrpc': '2.0', 'id': 1, 'result': None})
+
+        class FailingServer(ParinferServer):
+            __slots__ = ()
+            def call(self, method, params):
+                raise RuntimeError('boom')
+        response = FailingServer().handle({'id': 2, 'method': 'shutdown'})
+        self.assertEqual(response['error']['code'], -32603)
+
+    def test_server_position_encoding(self):
+        def initialize(server, capabilities):
+            response = server.handle({'id': 1, 'method': 'initialize', 'params': {'capabilities': capabilities}})
+            return response['result']['capabilities']['positionEncoding']
+
+        self.assertEqual(initialize(ParinferServer(), {}), 'utf-16')
+        self.assertEqual(initialize(ParinferServer(), {'general': {'positionEncodings': ['utf-7', 'utf-8']}}), 'utf-8')
+
+        # the emoji is two UTF-16 code units but one character
+        for encodings, character in ((['utf-16'], 4), (['utf-32'], 3), (['utf-8'], 6)):
+            server = ParinferServer()
+            initialize(server, {'general': {'positionEncodings': encodings}})
+            uri = 'file:///foo.clj'
+            server.handle({'method': 'textDocument/didOpen',
+                           'params': {'textDocument': {'uri': uri, 'text': '(\U0001F600 a)'}}})
+            server.handle({'method': 'textDocument/didChange', 'params': {
+                'textDocument': {'uri': uri},
+                'contentChanges': [{'range': {'start': {'line': 0, 'character': character},
+                                              'end': {'line': 0, 'character': character + 1}},
+                                    'text': 'b'}]
+            }})
+            response = server.handle({'id': 2, 'method': 'parinfer/parenMode',
+                                      'params': {'textDocument': {'uri': uri}}})
+            self.assertEqual(response['result']['text'], '(\U0001F600 b)')
+
+    def test_result_cache(self):
+        cache = enable_result_cache(maxEntries=2)
+        try:
+            first = paren_mode('(foo\nbar)', {'cursorLine': 0, 'cursorX': 1})
+            first['text'] = 'mutated'
+            second = paren_mode('(foo\nbar)', {'cursorLine': 0, 'cursorX': 1})
+            self.assertEqual(second['text'], '(foo\n bar)')
+            self.assertEqual(cache.stats()['hits'], 1)
+
+            # options that affect the result are part of the key
+            paren_mode('(foo\nbar)', {'cursorLine': 0, 'cursorX': 2})
+            indent_mode('(foo\nbar)', {'cursorLine': 0, 'cursorX': 1})
+            stats = cache.stats()
+            self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+            self.assertEqual((stats['entries'], stats['evictions']), (2, 1))
+        finally:
+            disable_result_cache()
+
+    def test_partitioned(self):
+        with open('./tests/perf/really_long_file') as f:
+            text = f.read()
+        options = {'cursorLine': 1000, 'cursorX': 4}
+        for mode in ('indent', 'paren', 'smart'):
+            expected = modeFn[mode](text, options)
+            self.assertEqual(partitioned_mode(text, options, mode, workers=2), expected)
+
+        # an unclosed string across a boundary falls back to processing everything
+        text = '(foo "\n(bar)\n(baz)'
+        for mode in ('indent', 'paren', 'smart'):
+            expected = modeFn[mode](text, None)
+            self.assertEqual(partitioned_mode(text, None, mode, workers=2, minLines=1), expected)
+
+    def test_form_cache(self):
+        text = '(foo\nbar)\n(baz\nqux)\n(quux "\n(a)'
+        edited = text.replace('bar', 'barr')
+        expected = {mode: [modeFn[mode](text, None), modeFn[mode](edited, None)]
+                    for mode in modeFn}
+        try:
+            enable_form_cache()
+            for mode in modeFn:
+                self.assertEqual([modeFn[mode](text, None), modeFn[mode](edited, None)], expected[mode])
+
+            # only the edited form and the form with the cursor are processed again
+            cache = enable_form_cache(maxEntries=2)
+            text = '(foo\nbar)\n(baz\nqux)'
+            indent_mode(text, None)
+            indent_mode(text.replace('bar', 'barr'), {'cursorLine': 0, 'cursorX': 1})
+            stats = cache.stats()
+            self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+            self.assertEqual((stats['entries'], stats['evictions']), (2, 1))
+        finally:
+            disable_form_cache()
+
+    def test_line_cache(self):
+        with open('./tests/perf/long_map_with_strings') as f:
+            text = f.read()
+        texts = [text, text.replace('"foo"', '"foo', 1), '(foo\n  "bar\n  baz"\n  "bar\n  baz")']
+        expected = {mode: [modeFn[mode](t, None) for t in texts] for mode in modeFn}
+        try:
+            cache = enable_line_cache()
+            for mode in modeFn:
+                self.assertEqual([modeFn[mode](t, None) for t in texts], expected[mode])
+            stats = cache.stats()
+            self.assertGreater(stats['hits'], stats['misses'])
+
+            # Smart Mode still resumes Paren Mode from the last top-level form
+            text = '(def a 1)\n\n' * 40 + '(let [a 1\n  ] a)'
+            disable_line_cache()
+            expected = smart_mode(text, {})
+            self.assertEqual(expected['fallbackLineNo'], 80)
+            enable_line_cache()
+            self.assertEqual(smart_mode(text, {}), expected)
+            self.assertEqual(smart_mode(text, {}), expected)
+        finally:
+            disable_line_cache()
+
+    def test_viewport(self):
+        with open('./tests/perf/really_long_file') as f:
+            text = f.read()
+        options = {'cursorLine': 1010, 'cursorX': 2}
+        for mode in ('indent', 'paren', 'smart'):
+            final = viewport_mode(text, options, 1000, 1040, mode)
+            expected = modeFn[mode](text, options)
+            start, end = final['startLine'], final['endLine']
+            self.assertTrue(final['partial'])
+            self.assertTrue(start <= 1000 and end >= 1040)
+            self.assertEqual(final['text'].split('\n'), expected['text'].split('\n')[start:end+1])
+            self.assertEqual(final['parenTrails'],
+                             [t for t in expected['parenTrails'] if start <= t['lineNo'] <= end])
+            self.assertEqual(final.get('tabStops'), expected.get('tabStops'))
+            self.assertEqual(final['cursorLine'], 1010)
+
 if __name__ == "__main__":
     unittest.main()